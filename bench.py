@@ -0,0 +1,181 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import tracemalloc
+
+import numba
+import numpy as np
+
+import iocell
+import bench_startup
+
+def result(value, unit, better):
+    'A single benchmark result, better is higher or lower'
+    return dict(value=float(value), unit=unit, better=better)
+
+def best_time(f, repeat):
+    'Best of repeat wall times of f()'
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def throughput(sim_seconds_list, record_every_list, ncells, repeat):
+    'Kernel speed of a single cell and a batch, for every sim_seconds and record_every'
+    results = {}
+    iocell.simulate(0, 0.01)
+    iocell.simulate_batch(0, 0.01, ncells=ncells)
+    for sim_seconds in sim_seconds_list:
+        for record_every in record_every_list:
+            key = f'sim_seconds={sim_seconds},record_every={record_every}'
+            steps = sim_seconds * 1000 / 0.025
+            wall = best_time(lambda: iocell.simulate(0, sim_seconds, record_every=record_every), repeat)
+            results[f'throughput.cell.{key}.sim_ms_per_s'] = result(sim_seconds * 1000 / wall, 'ms/s', 'higher')
+            results[f'throughput.cell.{key}.steps_per_s'] = result(steps / wall, 'steps/s', 'higher')
+            wall = best_time(lambda: iocell.simulate_batch(0, sim_seconds, record_every=record_every, ncells=ncells), repeat)
+            results[f'throughput.batch{ncells}.{key}.steps_per_s_per_cell'] = result(steps / wall, 'steps/s', 'higher')
+    return results
+
+def startup(repeat, cold):
+    'Import plus first simulate time of fresh interpreters, see bench_startup'
+    results = {}
+    modes = [('aot', {}), ('jit', dict(IOCELL_NO_AOT='1'))]
+    for mode, env in modes:
+        bench_startup.startup(1, env)
+        imported, simulated, aot = bench_startup.startup(repeat, env)
+        if mode == 'aot' and not aot:
+            continue
+        results[f'startup.{mode}.import'] = result(imported, 's', 'lower')
+        results[f'startup.{mode}.first_simulate'] = result(simulated, 's', 'lower')
+    if cold:
+        with tempfile.TemporaryDirectory() as cache_dir:
+            imported, simulated, _aot = bench_startup.startup(1, dict(IOCELL_NO_AOT='1', NUMBA_CACHE_DIR=cache_dir))
+        results['startup.jit_compile'] = result(simulated, 's', 'lower')
+    return results
+
+def peak_memory(f):
+    'Peak traced memory (bytes) allocated while running f()'
+    tracemalloc.start()
+    try:
+        f()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def trace_memory(sim_seconds_list, record_every_list):
+    'Peak memory of a full recording, and of a chunked one with only V_soma in float32'
+    results = {}
+    iocell.simulate(0, 0.01)
+    for sim_seconds in sim_seconds_list:
+        for record_every in record_every_list:
+            key = f'sim_seconds={sim_seconds},record_every={record_every}'
+            results[f'memory.simulate.{key}'] = result(
+                    peak_memory(lambda: iocell.simulate(0, sim_seconds, record_every=record_every)) / 2**20, 'MiB', 'lower')
+            results[f'memory.chunks.{key}'] = result(peak_memory(lambda: [None for _ in iocell.simulate_chunks(
+                    0, sim_seconds, record_every=record_every, record=['V_soma'], dtype=np.float32)]) / 2**20, 'MiB', 'lower')
+    return results
+
+def gui_latency(repeat):
+    '''Slider change to first (partial) and final plot latency of main.Window with offscreen Qt
+
+    Measured for a small change that warm starts from the previous state, a
+    large change that needs the full transient and a change back that hits
+    the result cache, which is kept in memory only and emptied before every
+    small change.'''
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    try:
+        from PyQt5.QtWidgets import QApplication
+        import main
+    except ImportError:
+        return {}
+    app = QApplication.instance() or QApplication([])
+    main.result_cache_dir = None
+    window = main.Window()
+    plots = []
+    plot = window.plot
+    def timed_plot(params, iv_trace, final=True):
+        plot(params, iv_trace, final)
+        plots.append((time.perf_counter(), final))
+    window.plot = timed_plot
+    def change(slider, value):
+        del plots[:]
+        start = time.perf_counter()
+        slider.setValue(value)
+        while not (plots and plots[-1][1]):
+            app.processEvents()
+            time.sleep(0.0002)
+        return plots[0][0] - start, plots[-1][0] - start
+    slider = window.sliders['g_CaL']
+    change(slider, slider.value())
+    base = slider.value()
+    latencies = {'warm': [], 'transient': [], 'cached': []}
+    for i in range(repeat):
+        window.worker.cache.clear()
+        latencies['warm'].append(change(slider, base + 1 + i % 2))
+        latencies['transient'].append(change(slider, base + 50 + i))
+        latencies['cached'].append(change(slider, base + 1 + i % 2))
+    window.close()
+    results = {}
+    for kind, values in latencies.items():
+        first, final = np.median(values, axis=0)
+        results[f'gui.{kind}.first_plot'] = result(first * 1000, 'ms', 'lower')
+        results[f'gui.{kind}.final_plot'] = result(final * 1000, 'ms', 'lower')
+    return results
+
+def compare(results, baseline, threshold):
+    'Print the change against a baseline, returns the names of the results that regressed more than threshold'
+    regressions = []
+    print(f'{"benchmark":<70} {"baseline":>10} {"now":>10} {"change":>8}')
+    for name, r in results.items():
+        if name not in baseline:
+            continue
+        old = baseline[name]['value']
+        change = r['value'] / old - 1 if old else 0.
+        worse = -change if r['better'] == 'higher' else change
+        flag = ' REGRESSION' if worse > threshold else ''
+        if flag:
+            regressions.append(name)
+        print(f'{name:<70} {old:>10.4g} {r["value"]:>10.4g} {change:>+8.1%}{flag}')
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark suite: kernel throughput, startup, trace memory and GUI latency')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline', help='compare against the results stored in this file')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative change counted as a regression')
+    parser.add_argument('--sim-seconds', type=float, nargs='+', default=[0.1, 1, 10])
+    parser.add_argument('--record-every', type=int, nargs='+', default=[1, 4, 20])
+    parser.add_argument('--ncells', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--quick', action='store_true', help='skip the cold compile and GUI benchmarks')
+    args = parser.parse_args()
+    results = {}
+    results.update(throughput(args.sim_seconds, args.record_every, args.ncells, args.repeat))
+    results.update(startup(args.repeat, cold=not args.quick))
+    results.update(trace_memory(args.sim_seconds, args.record_every))
+    if not args.quick:
+        results.update(gui_latency(args.repeat))
+    report = dict(
+        machine=dict(platform=platform.platform(), python=platform.python_version(),
+                     numba=numba.__version__, numpy=np.__version__, threads=numba.get_num_threads()),
+        results=results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+    else:
+        for name, r in results.items():
+            print(f'{name:<70} {r["value"]:>10.4g} {r["unit"]}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+import time
+import argparse
+
+import numpy as np
+
+import iocell
+
+def spike_times(V, t, threshold=-20.):
+    'Upward threshold crossings of V, linearly interpolated between samples'
+    i = np.flatnonzero((V[:-1] < threshold) & (V[1:] >= threshold))
+    return t[i] + (threshold - V[i]) / (V[i+1] - V[i]) * (t[i+1] - t[i])
+
+def interval_error(spikes, reference):
+    '''Largest interspike interval error (ms) against the reference spike train
+
+    Intervals are compared instead of spike times as small phase differences
+    accumulate over the transient, nan if the spike counts differ.'''
+    if len(spikes) != len(reference):
+        return np.nan
+    return abs(np.diff(spikes) - np.diff(reference)).max(initial=0)
+
+def run(skip, sim_seconds, delta, sample_interval=0.1, repeat=3, **kwargs):
+    'Best of repeat wall time and the soma spike times, V_soma is recorded every sample_interval ms'
+    record_every = max(1, int(round(sample_interval / delta)))
+    kwargs = dict(record=['V_soma', 't'], delta=delta, record_every=record_every, **kwargs)
+    iocell.simulate(0, 0.01, **kwargs)
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        iv_trace = iocell.simulate(skip, sim_seconds, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best, spike_times(*iv_trace.T)
+
+def main():
+    parser = argparse.ArgumentParser(description='Integration scheme speed and spike timing accuracy')
+    parser.add_argument('--sim-seconds', type=float, default=2)
+    parser.add_argument('--skip', type=float, default=1)
+    parser.add_argument('--reference-delta', type=float, default=0.0005)
+    parser.add_argument('--tolerance', type=float, default=0.5, help='interspike interval tolerance (ms)')
+    parser.add_argument('--g-CaL', type=float, default=1.4)
+    parser.add_argument('--I-app', type=float, default=0)
+    args = parser.parse_args()
+    params = dict(g_CaL=args.g_CaL, I_app=args.I_app)
+    _wall, reference = run(args.skip, args.sim_seconds, args.reference_delta, repeat=1, **params)
+    current_wall, current = run(args.skip, args.sim_seconds, 0.025, **params)
+    configs = [
+        ('euler', 0.025, {}),
+        ('euler', 0.05, {}),
+        ('exponential', 0.025, {}),
+        ('exponential', 0.05, {}),
+        ('exponential', 0.075, {}),
+        ('exponential', 0.1, {}),
+        ('adaptive', 0.1, dict(tolerance=1e-3)),
+        ('adaptive', 0.1, dict(tolerance=1e-4)),
+        ('adaptive', 0.1, dict(tolerance=1e-5)),
+        ]
+    print(f'reference: euler delta={args.reference_delta}, {len(reference)} spikes, '
+          f'mean interval {np.diff(reference).mean():.2f} ms')
+    print(f'{"method":>12} {"delta":>6} {"tolerance":>9} {"wall (s)":>8} {"speedup":>7} '
+          f'{"spikes":>6} {"ISI err":>7} {"vs euler":>8} {"ok":>3}')
+    for method, delta, kwargs in configs:
+        try:
+            wall, spikes = run(args.skip, args.sim_seconds, delta, method=method, **kwargs, **params)
+        except (ZeroDivisionError, FloatingPointError):
+            print(f'{method:>12} {delta:>6} {kwargs.get("tolerance", ""):>9} unstable')
+            continue
+        error = interval_error(spikes, reference)
+        ok = 'yes' if error <= args.tolerance else 'no'
+        print(f'{method:>12} {delta:>6} {kwargs.get("tolerance", ""):>9} {wall:>8.3f} {current_wall/wall:>7.2f} '
+              f'{len(spikes):>6} {error:>7.3f} {interval_error(spikes, current):>8.3f} {ok:>3}', flush=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+import sys
+import time
+import argparse
+
+import numpy as np
+
+import iocell
+import iomodel
+
+def steps_per_second(simulate, sim_seconds, delta=0.025, repeat=5, **kwargs):
+    'Best of repeat timesteps per wall second for a single cell'
+    simulate(sim_seconds=0.01, delta=delta, **kwargs)
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        simulate(sim_seconds=sim_seconds, delta=delta, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return sim_seconds * 1000 / delta / best
+
+# Configurations compared, the specialised kernel freezes all their parameters
+configurations = {
+    'default': {},
+    'noise': dict(I_noise_amp=0.5, seed=0),
+    'no CaH': dict(g_CaH=0.),
+    'no CaH, Na_a, K_a': dict(g_CaH=0., g_Na_a=0., g_K_a=0.),
+}
+
+def check(sim_seconds=1):
+    '''Compare the traces of iomodel against iocell bit for bit, True when all are identical
+
+    Covers every method, with and without noise (not for adaptive steps), the
+    runtime (nothing frozen), default and fully frozen kernels and a batch
+    with per cell parameters.'''
+    identical = True
+    for method in iocell.integration_methods:
+        kwargs = dict(skip_initial_transient_seconds=0.1, sim_seconds=sim_seconds, method=method, seed=0)
+        noise = dict(I_noise_amp=0.) if method == 'adaptive' else dict(I_noise_amp=0.5)
+        for name, params in configurations.items():
+            if method == 'adaptive' and 'I_noise_amp' in params:
+                continue
+            params = {**kwargs, **params}
+            reference = iocell.simulate(**params)
+            for frozen, freeze in (('nothing', ()), ('default', None), ('all', list(iocell.params_default))):
+                same = np.array_equal(reference, iomodel.simulate(freeze=freeze, **params), equal_nan=True)
+                print(f'{method:>12} {name:>20} {frozen:>8} frozen {"identical" if same else "DIFFERENT"}', flush=True)
+                identical &= same
+        g_CaL = np.linspace(0.5, 1.5, 8)
+        same = np.array_equal(iocell.simulate_batch(**kwargs, ncells=8, g_CaL=g_CaL, **noise),
+                              iomodel.simulate_batch(**kwargs, ncells=8, g_CaL=g_CaL, **noise), equal_nan=True)
+        print(f'{method:>12} {"batch":>20} {"identical" if same else "DIFFERENT"}', flush=True)
+        identical &= same
+    return identical
+
+def main():
+    parser = argparse.ArgumentParser(description='Speed of kernels specialised by iomodel against iocell')
+    parser.add_argument('--sim-seconds', type=float, default=2)
+    parser.add_argument('--method', choices=list(iocell.integration_methods), default='euler')
+    parser.add_argument('--check', action='store_true', help='only compare the traces bit for bit, exit 1 on a difference')
+    args = parser.parse_args()
+    if args.check:
+        sys.exit(0 if check(args.sim_seconds) else 1)
+    V = [iocell.trace_names.index(k) for k in ('V_soma', 'V_axon', 'V_dend')]
+    print(f'{"configuration":>20} {"iocell":>10} {"iomodel":>10} {"speedup":>8} {"compile":>8} {"max V diff":>10}')
+    # Freezing every parameter shows the best case, the default only drops zero channels and inputs
+    freeze = list(iocell.params_default)
+    for name, params in configurations.items():
+        params = dict(params, freeze=freeze)
+        start = time.perf_counter()
+        iomodel.simulate(0, 0.01, method=args.method, **params)
+        compiled = time.perf_counter() - start
+        reference_params = {k: v for k, v in params.items() if k != 'freeze'}
+        reference = steps_per_second(iocell.simulate, args.sim_seconds, method=args.method, **reference_params)
+        specialised = steps_per_second(iomodel.simulate, args.sim_seconds, method=args.method, **params)
+        V_diff = abs(iocell.simulate(1, args.sim_seconds, method=args.method, **reference_params)[:, V] -
+                     iomodel.simulate(1, args.sim_seconds, method=args.method, **params)[:, V]).max()
+        print(f'{name:>20} {reference:>10.3g} {specialised:>10.3g} {specialised/reference:>8.2f} '
+              f'{compiled:>8.2f} {V_diff:>10.3g}', flush=True)
+
+if __name__ == '__main__':
+    main()
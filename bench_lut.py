@@ -0,0 +1,37 @@
+import time
+import argparse
+
+import numpy as np
+
+import iocell
+
+def steps_per_second(sim_seconds, delta=0.025, repeat=5, **kwargs):
+    'Best of repeat timesteps per wall second for a single cell'
+    iocell.simulate(sim_seconds=0.01, delta=delta, **kwargs)
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        iocell.simulate(sim_seconds=sim_seconds, delta=delta, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return sim_seconds * 1000 / delta / best
+
+def main():
+    parser = argparse.ArgumentParser(description='Rate lookup table speed and accuracy')
+    parser.add_argument('--resolutions', type=float, nargs='+', default=[0.5, 0.1, 0.05, 0.01])
+    parser.add_argument('--sim-seconds', type=float, default=2)
+    parser.add_argument('--g-CaL', type=float, default=1.1)
+    args = parser.parse_args()
+    exact_sps = steps_per_second(args.sim_seconds, g_CaL=args.g_CaL)
+    exact = iocell.simulate(1, args.sim_seconds, record_every=1, g_CaL=args.g_CaL)
+    V = [iocell.trace_names.index(k) for k in ('V_soma', 'V_axon', 'V_dend')]
+    print(f'{"resolution":>10} {"steps/s":>10} {"speedup":>8} {"max rate err":>12} {"max V err":>10}')
+    print(f'{"exact":>10} {exact_sps:>10.3g} {1:>8.2f} {0:>12.3g} {0:>10.3g}')
+    for resolution in args.resolutions:
+        sps = steps_per_second(args.sim_seconds, g_CaL=args.g_CaL, lut_resolution=resolution)
+        approx = iocell.simulate(1, args.sim_seconds, record_every=1, g_CaL=args.g_CaL, lut_resolution=resolution)
+        rate_error = iocell.rate_table_error(resolution).max()
+        V_error = abs(exact[:, V] - approx[:, V]).max()
+        print(f'{resolution:>10} {sps:>10.3g} {sps/exact_sps:>8.2f} {rate_error:>12.3g} {V_error:>10.3g}')
+
+if __name__ == '__main__':
+    main()
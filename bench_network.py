@@ -0,0 +1,33 @@
+import time
+import argparse
+
+import numba
+import numpy as np
+
+import ionet
+
+def bench(ncells, connections_per_cell, sim_seconds):
+    'Wall time per simulated second for a random network'
+    conn = ionet.random_connectivity(ncells, connections_per_cell, seed=0)
+    I_app = np.random.default_rng(0).uniform(0, 0.5, ncells)
+    start = time.perf_counter()
+    ionet.simulate_network(conn, sim_seconds=sim_seconds, record_every=40, record_cells=[0], I_app=I_app)
+    return (time.perf_counter() - start) / sim_seconds, conn.nnz
+
+def main():
+    parser = argparse.ArgumentParser(description='Gap junction network benchmark')
+    parser.add_argument('--ncells', type=int, nargs='+', default=[100, 1000, 10000, 100000])
+    parser.add_argument('--connections', type=int, nargs='+', default=[0, 10, 50])
+    parser.add_argument('--sim-seconds', type=float, default=0.1)
+    args = parser.parse_args()
+    # Compile outside of the measurements
+    bench(10, 2, 0.001)
+    print(f'threads={numba.get_num_threads()}')
+    print(f'{"ncells":>8} {"conn/cell":>9} {"nnz":>9} {"s/sim s":>9} {"us/cell/ms":>10}')
+    for ncells in args.ncells:
+        for connections in args.connections:
+            wall, nnz = bench(ncells, connections, args.sim_seconds)
+            print(f'{ncells:>8} {connections:>9} {nnz:>9} {wall:>9.3f} {1e3*wall/ncells:>10.3f}', flush=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+
+import numpy as np
+
+# Timed in a fresh interpreter, prints the import and first simulate time as json
+_probe = '''
+import time, json
+start = time.perf_counter()
+import iocell
+imported = time.perf_counter()
+iocell.simulate(0, 0.01)
+done = time.perf_counter()
+print(json.dumps(dict(imported=imported - start, simulated=done - imported, aot=iocell._aot_module() is not None)))
+'''
+
+def startup(repeat=5, env=None):
+    'Median import and first simulate time (s) over repeat fresh interpreters'
+    env = {**os.environ, **(env or {})}
+    here = os.path.dirname(os.path.abspath(__file__))
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [here, env.get('PYTHONPATH')]))
+    runs = [json.loads(subprocess.run([sys.executable, '-c', _probe], env=env, check=True,
+                                      capture_output=True, text=True).stdout.splitlines()[-1])
+            for _ in range(repeat)]
+    return (np.median([r['imported'] for r in runs]), np.median([r['simulated'] for r in runs]), runs[0]['aot'])
+
+def main():
+    parser = argparse.ArgumentParser(description='Time to import iocell and finish a first simulation')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--cold', action='store_true', help='also time an empty numba cache (compiles everything)')
+    args = parser.parse_args()
+    print(f'{"mode":>10} {"import":>8} {"simulate":>8} {"total":>8}')
+    modes = [('aot', {}), ('jit', dict(IOCELL_NO_AOT='1'))]
+    with tempfile.TemporaryDirectory() as cache_dir:
+        if args.cold:
+            modes.append(('jit cold', dict(IOCELL_NO_AOT='1', NUMBA_CACHE_DIR=cache_dir)))
+        for mode, env in modes:
+            if mode == 'jit cold':
+                imported, simulated, aot = startup(1, env)
+            else:
+                # The first run fills the numba cache
+                startup(1, env)
+                imported, simulated, aot = startup(args.repeat, env)
+            if mode == 'aot' and not aot:
+                print(f'{mode:>10} not built, run build_aot.py')
+                continue
+            print(f'{mode:>10} {imported:>8.3f} {simulated:>8.3f} {imported + simulated:>8.3f}', flush=True)
+
+if __name__ == '__main__':
+    main()
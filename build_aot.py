@@ -0,0 +1,47 @@
+import os
+import time
+import argparse
+
+import numba
+from numba.pycc import CC
+
+import iocell
+
+def flat_signature(dtype):
+    'Signature of the single cell kernel with the rate table and feature option tuples passed as separate arguments'
+    cell, _cells = iocell.kernel_signatures(dtype)
+    args = list(cell.args)
+    lut, options = args[12], args[16]
+    return cell.return_type(*args[:12], *lut.types, *args[13:16], *options.types, *args[17:])
+
+def simulate_cell(state, params, iv_trace, columns, decimate, nskip, nepochs, record_every,
+        delta, t0, pulse_start, pulse_end, table, v_min, inv_dv, method, tolerance,
+        acc, spike_threshold, burst_interval, prominence, noise_key, step0):
+    return iocell._simulate_cell(state, params, iv_trace, columns, decimate, nskip, nepochs, record_every,
+            delta, t0, pulse_start, pulse_end, (table, v_min, inv_dv), method, tolerance,
+            acc, (spike_threshold, burst_interval, prominence), noise_key, step0)
+
+def build(output_dir):
+    '''Compile the single cell kernel into the _iocell_aot extension module
+
+    iocell uses it for simulate, simulate_chunks and simulate_to_file as long
+    as iocell.py and iofeatures.py are unchanged, so fresh processes skip
+    loading numba's compiler. Batch and network kernels remain JIT compiled.'''
+    cc = CC('_iocell_aot')
+    cc.output_dir = output_dir
+    for dtype in ('float64', 'float32'):
+        cc.export(f'simulate_cell_{dtype}', flat_signature(dtype))(simulate_cell)
+    source_hash = iocell._source_hash()
+    cc.export('source_hash', numba.int64())(lambda: source_hash)
+    cc.compile()
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the ahead-of-time compiled iocell kernel')
+    parser.add_argument('--output-dir', default=os.path.dirname(os.path.abspath(iocell.__file__)))
+    args = parser.parse_args()
+    start = time.perf_counter()
+    build(args.output_dir)
+    print(f'built _iocell_aot in {args.output_dir} ({time.perf_counter() - start:.1f} s)')
+
+if __name__ == '__main__':
+    main()
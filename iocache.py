@@ -0,0 +1,159 @@
+import os
+import json
+import hashlib
+import functools
+import collections
+
+import numpy as np
+
+import iocell
+
+# Version of the key and entry format, part of every key
+CACHE_VERSION = 1
+
+# Significant digits of the parameter values that are part of a key
+param_digits = 10
+
+@functools.lru_cache
+def model_version():
+    'Changes whenever the model changes, see iocell._source_hash'
+    return iocell._source_hash()
+
+def round_params(values, digits=param_digits):
+    'Scalar or array values rounded to digits significant digits'
+    values = np.asarray(values, dtype=np.float64)
+    with np.errstate(divide='ignore'):
+        exponent = np.floor(np.log10(np.abs(values)))
+    scale = 10. ** (digits - 1 - np.where(np.isfinite(exponent), exponent, 0))
+    # + 0. turns -0. into 0.
+    return np.round(values * scale) / scale + 0.
+
+def _jsonable(x):
+    if isinstance(x, (np.ndarray, np.generic)):
+        return x.tolist()
+    raise TypeError(f'Cannot use {type(x).__name__} in a cache key')
+
+def key(params, **settings):
+    '''Content address of a simulation result
+
+    A hash of the params (scalars or arrays per params_default key, missing
+    keys take their default) rounded by round_params, the settings (anything
+    else that determines the result, json-able or numpy arrays) and the
+    model_version. seed and stream settings are left out when I_noise_amp is
+    zero for all cells, as they do not change the result then.'''
+    params = {**iocell.params_default, **params}
+    if not np.any(np.asarray(params['I_noise_amp']) != 0):
+        settings = {k: v for k, v in settings.items() if k not in ('seed', 'stream')}
+    content = dict(
+            version=CACHE_VERSION, model=model_version(), settings=settings,
+            params={k: round_params(v).tolist() for k, v in params.items()})
+    return hashlib.sha1(json.dumps(content, sort_keys=True, default=_jsonable).encode()).hexdigest()
+
+def _nbytes(value):
+    return sum(v.nbytes for v in value.values())
+
+class ResultCache:
+    '''Simulation results by key(), in memory and optionally on disk
+
+    Values are dicts of numpy arrays, returned read-only. The memory tier keeps
+    the most recently used values up to memory_bytes, the disk tier keeps one
+    .npz file per key in path (None for memory only) up to disk_bytes, evicting
+    the least recently used files. Several processes may share a path.'''
+
+    def __init__(self, path=None, memory_bytes=2**28, disk_bytes=2**30):
+        self.path = path
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.memory = collections.OrderedDict()
+        self.memory_used = 0
+        self.hits = 0
+        self.misses = 0
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+    def filename(self, key):
+        return os.path.join(self.path, f'{key}.npz')
+
+    def get(self, key):
+        'The value stored under key, None when it is not cached'
+        value = self.memory.get(key)
+        if value is not None:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return value
+        if self.path is not None:
+            try:
+                with np.load(self.filename(key)) as f:
+                    value = {k: f[k] for k in f.files}
+                # Marks the file as recently used for the eviction
+                os.utime(self.filename(key))
+            except (OSError, ValueError):
+                # Missing, or evicted by another process meanwhile
+                value = None
+            if value is not None:
+                for v in value.values():
+                    v.flags.writeable = False
+                self.remember(key, value)
+                self.hits += 1
+                return value
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        'Store a copy of the dict of arrays value under key'
+        value = {k: np.array(v) for k, v in value.items()}
+        for v in value.values():
+            v.flags.writeable = False
+        self.remember(key, value)
+        if self.path is not None:
+            # Written under a temporary name so other processes never read a partial file
+            filename = self.filename(key)
+            with open(f'{filename}.{os.getpid()}.tmp', 'wb') as f:
+                np.savez(f, **value)
+            os.replace(f'{filename}.{os.getpid()}.tmp', filename)
+            self.evict()
+
+    def remember(self, key, value):
+        'Keep value in the memory tier, evicting the least recently used values beyond memory_bytes'
+        if key in self.memory:
+            self.memory_used -= _nbytes(self.memory.pop(key))
+        if _nbytes(value) > self.memory_bytes:
+            return
+        self.memory[key] = value
+        self.memory_used += _nbytes(value)
+        while self.memory_used > self.memory_bytes:
+            _key, old = self.memory.popitem(last=False)
+            self.memory_used -= _nbytes(old)
+
+    def evict(self):
+        'Remove the least recently used files of the disk tier until it fits in disk_bytes'
+        files = []
+        for entry in os.scandir(self.path):
+            if not entry.name.endswith('.npz'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+        used = sum(size for _mtime, size, _filename in files)
+        for _mtime, size, filename in sorted(files):
+            if used <= self.disk_bytes:
+                break
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+            used -= size
+
+    def clear(self):
+        'Remove all values from both tiers'
+        self.memory.clear()
+        self.memory_used = 0
+        if self.path is not None:
+            for entry in os.scandir(self.path):
+                if entry.name.endswith('.npz'):
+                    try:
+                        os.remove(entry.path)
+                    except FileNotFoundError:
+                        pass
@@ -1,240 +1,1131 @@
-import matplotlib.pyplot as plt
+import os
+import json
+import hashlib
+import warnings
+import functools
+import threading
+
 import numba
 import numpy as np
 
-@numba.jit(fastmath=False, cache=True, nopython=True)
-def simulate(skip_initial_transient_seconds=0, sim_seconds=10, delta=0.025, record_every=20,
-        # Parameters
-        g_int           =   0.13,    # Cell internal conductance  -- now a parameter (0.13)
-        p1              =   0.25,    # Cell surface ratio soma/dendrite
-        p2              =   0.15,    # Cell surface ratio axon(hillock)/soma
-        g_CaL           =   1.1,     # Calcium T - (CaV 3.1) (0.7)
-        g_h             =   0.12,    # H current (HCN) (0.4996)
-        g_K_Ca          =  35.0,     # Potassium  (KCa v1.1 - BK) (35)
-        g_ld            =   0.01532, # Leak dendrite (0.016)
-        g_la            =   0.016,   # Leak axon (0.016)
-        g_ls            =   0.016,   # Leak soma (0.016)
-        S               =   1.0,     # 1/C_m, cm^2/uF
-        g_Na_s          = 150.0,     # Sodium  - (Na v1.6 )
-        g_Kdr_s         =   9.0,     # Potassium - (K v4.3)
-        g_K_s           =   5.0,     # Potassium - (K v3.4)
-        g_CaH           =   4.5,     # High-threshold calcium -- Ca V2.1
-        g_Na_a          = 240.0,     # Sodium
-        g_K_a           = 240.0,     # Potassium (20)
-        V_Na            =  55.0,     # Sodium
-        V_K             = -75.0,     # Potassium
-        V_Ca            = 120.0,     # Low-threshold calcium channel
-        V_h             = -43.0,     # H current
-        V_l             =  10.0,     # Leak
-        I_app           =   0.0,
-        I_pulse10ms     =   0.0,
-        I_noise_amp     =   0.0
-        ):
+import iofeatures
+import ioprofile
 
-    # Soma state
-    V_soma          = -60.0
-    soma_k          =   0.7423159
-    soma_l          =   0.0321349
-    soma_h          =   0.3596066
-    soma_n          =   0.2369847
-    soma_x          =   0.1
+params_default = dict(
+    g_int           =   0.13,    # Cell internal conductance  -- now a parameter (0.13)
+    p1              =   0.25,    # Cell surface ratio soma/dendrite
+    p2              =   0.15,    # Cell surface ratio axon(hillock)/soma
+    g_CaL           =   1.1,     # Calcium T - (CaV 3.1) (0.7)
+    g_h             =   0.12,    # H current (HCN) (0.4996)
+    g_K_Ca          =  35.0,     # Potassium  (KCa v1.1 - BK) (35)
+    g_ld            =   0.01532, # Leak dendrite (0.016)
+    g_la            =   0.016,   # Leak axon (0.016)
+    g_ls            =   0.016,   # Leak soma (0.016)
+    S               =   1.0,     # 1/C_m, cm^2/uF
+    g_Na_s          = 150.0,     # Sodium  - (Na v1.6 )
+    g_Kdr_s         =   9.0,     # Potassium - (K v4.3)
+    g_K_s           =   5.0,     # Potassium - (K v3.4)
+    g_CaH           =   4.5,     # High-threshold calcium -- Ca V2.1
+    g_Na_a          = 240.0,     # Sodium
+    g_K_a           = 240.0,     # Potassium (20)
+    V_Na            =  55.0,     # Sodium
+    V_K             = -75.0,     # Potassium
+    V_Ca            = 120.0,     # Low-threshold calcium channel
+    V_h             = -43.0,     # H current
+    V_l             =  10.0,     # Leak
+    I_app           =   0.0,
+    I_pulse10ms     =   0.0,
+    I_noise_amp     =   0.0
+)
 
+state_default = dict(
+    # Soma state
+    V_soma          = -60.0,
+    soma_k          =   0.7423159,
+    soma_l          =   0.0321349,
+    soma_h          =   0.3596066,
+    soma_n          =   0.2369847,
+    soma_x          =   0.1,
     # Axon state
-    V_axon          = -60.0
-    axon_Sodium_h   =   0.9
-    axon_Potassium_x=   0.2369847
-
+    V_axon          = -60.0,
+    axon_Sodium_h   =   0.9,
+    axon_Potassium_x=   0.2369847,
     # Dend state
-    V_dend          = -60.0
-    dend_Ca2Plus    =   3.715
-    dend_Calcium_r  =   0.0113
-    dend_Potassium_s=   0.0049291
+    V_dend          = -60.0,
+    dend_Ca2Plus    =   3.715,
+    dend_Calcium_r  =   0.0113,
+    dend_Potassium_s=   0.0049291,
     dend_Hcurrent_q =   0.0337836
+)
+
+state_names = tuple(state_default)
+
+trace_names = (
+    'soma_Ik', 'soma_Ikdr', 'soma_Ina', 'soma_Ical', 'V_soma',
+    'axon_Ina', 'axon_Ik', 'V_axon',
+    'dend_Icah', 'dend_Ikca', 'dend_Ih', 'V_dend', 't')
+
+@numba.njit(fastmath=False, cache=True)
+def _soma_rates(V_soma):
+    'Voltage dependent gating of the soma channels'
+    # CHANNEL: Soma Low-threshold calcium (CaL)
+    soma_k_inf  = 1 / (1 + np.exp(-(V_soma + 61)/4.2))
+    soma_l_inf  = 1 / (1 + np.exp( (V_soma + 85)/8.5))
+    soma_tau_l  = (20 * np.exp((V_soma + 160)/30) / (1 + np.exp((V_soma + 84) / 7.3))) + 35
+
+    # CHANNEL: Soma sodium (Na_s)
+    soma_m_inf  = 1 / (1 + np.exp(-(V_soma + 30)/5.5))
+    soma_h_inf  = 1 / (1 + np.exp( (V_soma + 70)/5.8))
+    soma_tau_h  = 3 * np.exp(-(V_soma + 40)/33)
+
+    # CHANNEL: Soma potassium, slow component (Kdr)
+    soma_n_inf  = 1 / ( 1 + np.exp(-(V_soma +  3)/10))
+    soma_tau_n  = 5 + (47 * np.exp( (V_soma + 50)/900))
+
+    # CHANNEL: Soma potassium, fast component (K_s)
+    soma_alpha_x = 0.13 * (V_soma + 25) / (1 - np.exp(-(V_soma + 25)/10))
+    soma_beta_x  = 1.69 * np.exp(-(V_soma + 35)/80)
+    soma_tau_x_inv=soma_alpha_x + soma_beta_x
+    soma_x_inf   = soma_alpha_x / soma_tau_x_inv
+
+    return (soma_k_inf, soma_l_inf, soma_tau_l, soma_m_inf, soma_h_inf, soma_tau_h,
+            soma_n_inf, soma_tau_n, soma_x_inf, soma_tau_x_inv)
+
+@numba.njit(fastmath=False, cache=True)
+def _axon_rates(V_axon):
+    'Voltage dependent gating of the axon hillock channels'
+    # CHANNEL: Axon sodium (Na_a)
+    axon_m_inf     =  1 / (1 + np.exp(-(V_axon+30)/5.5))
+    axon_h_inf     =  1 / (1 + np.exp( (V_axon+60)/5.8))
+    axon_tau_h     =  1.5 * np.exp(-(V_axon+40)/33)
+
+    # CHANNEL: Axon potassium (K_a)
+    axon_alpha_x   =  0.13*(V_axon + 25) / (1 - np.exp(-(V_axon + 25)/10))
+    axon_beta_x    =  1.69 * np.exp(-(V_axon + 35)/80)
+    axon_tau_x_inv =  axon_alpha_x + axon_beta_x
+    axon_x_inf     =  axon_alpha_x / axon_tau_x_inv
+
+    return (axon_m_inf, axon_h_inf, axon_tau_h, axon_x_inf, axon_tau_x_inv)
+
+@numba.njit(fastmath=False, cache=True)
+def _dend_rates(V_dend):
+    'Voltage dependent gating of the dendrite channels'
+    # CHANNEL: Dend high-threshold calcium (CaH)
+    dend_alpha_r    =  1.7 / (1 + np.exp(-(V_dend - 5)/13.9))
+    dend_beta_r     =  0.02*(V_dend + 8.5) / (np.exp((V_dend + 8.5)/5) - 1.0)
+    dend_tau_r_inv5 =  (dend_alpha_r + dend_beta_r) # tau = 5 / (alpha + beta)
+    dend_r_inf      =  dend_alpha_r / dend_tau_r_inv5
+
+    # CHANNEL: Dend proton (h)
+    q_inf           =  1 / (1 + np.exp((V_dend + 80)/4))
+    tau_q_inv       =  np.exp(-0.086*V_dend - 14.6) + np.exp(0.070*V_dend - 1.87)
+
+    return (dend_r_inf, dend_tau_r_inv5, q_inf, tau_q_inv)
+
+# Rate table columns, in the order the _*_rates functions return them
+_SOMA_RATES, _AXON_RATES, _DEND_RATES = 0, 10, 15
+_NRATES = 19
+
+@numba.njit(fastmath=False, cache=True, inline='always')
+def _lerp(table, i, f, column):
+    return table[i, column] + f * (table[i+1, column] - table[i, column])
+
+@numba.njit(fastmath=False, cache=True)
+def _soma_rates_lut(lut, V_soma):
+    'Soma gating interpolated from the rate table, exact outside of its range'
+    table, v_min, inv_dv = lut
+    x = (V_soma - v_min) * inv_dv
+    if not 0 <= x < table.shape[0] - 1:
+        return _soma_rates(V_soma)
+    i = int(x)
+    f = x - i
+    c = _SOMA_RATES
+    return (_lerp(table, i, f, c+0), _lerp(table, i, f, c+1), _lerp(table, i, f, c+2),
+            _lerp(table, i, f, c+3), _lerp(table, i, f, c+4), _lerp(table, i, f, c+5),
+            _lerp(table, i, f, c+6), _lerp(table, i, f, c+7), _lerp(table, i, f, c+8),
+            _lerp(table, i, f, c+9))
+
+@numba.njit(fastmath=False, cache=True)
+def _axon_rates_lut(lut, V_axon):
+    'Axon hillock gating interpolated from the rate table, exact outside of its range'
+    table, v_min, inv_dv = lut
+    x = (V_axon - v_min) * inv_dv
+    if not 0 <= x < table.shape[0] - 1:
+        return _axon_rates(V_axon)
+    i = int(x)
+    f = x - i
+    c = _AXON_RATES
+    return (_lerp(table, i, f, c+0), _lerp(table, i, f, c+1), _lerp(table, i, f, c+2),
+            _lerp(table, i, f, c+3), _lerp(table, i, f, c+4))
+
+@numba.njit(fastmath=False, cache=True)
+def _dend_rates_lut(lut, V_dend):
+    'Dendrite gating interpolated from the rate table, exact outside of its range'
+    table, v_min, inv_dv = lut
+    x = (V_dend - v_min) * inv_dv
+    if not 0 <= x < table.shape[0] - 1:
+        return _dend_rates(V_dend)
+    i = int(x)
+    f = x - i
+    c = _DEND_RATES
+    return (_lerp(table, i, f, c+0), _lerp(table, i, f, c+1), _lerp(table, i, f, c+2),
+            _lerp(table, i, f, c+3))
+
+@numba.njit(fastmath=False, cache=True)
+def _fill_rate_table(voltages, table):
+    for i in range(len(voltages)):
+        soma = _soma_rates(voltages[i])
+        for j in range(len(soma)):
+            table[i, _SOMA_RATES + j] = soma[j]
+        axon = _axon_rates(voltages[i])
+        for j in range(len(axon)):
+            table[i, _AXON_RATES + j] = axon[j]
+        dend = _dend_rates(voltages[i])
+        for j in range(len(dend)):
+            table[i, _DEND_RATES + j] = dend[j]
+
+# Voltages where alpha_x and beta_r are 0/0, the tables hold their limits
+_removable_singularities = (-25., -8.5)
+
+@functools.lru_cache(maxsize=8)
+def rate_table(resolution=0.05, v_min=-150., v_max=100.):
+    '''Gating rate lookup table with a resolution in mV, as used by lut_resolution
+
+    None of the rate functions depend on params_default, so a table only
+    depends on its voltage grid and is built once per resolution. Voltages
+    outside [v_min, v_max] fall back to the exact rate functions.'''
+    npoints = int(round((v_max - v_min) / resolution)) + 1
+    voltages = v_min + resolution * np.arange(npoints)
+    table = np.empty((npoints, _NRATES))
+    singular = np.isin(voltages.round(9), _removable_singularities)
+    regular = np.empty((npoints - singular.sum(), _NRATES))
+    _fill_rate_table(voltages[~singular], regular)
+    table[~singular] = regular
+    if singular.any():
+        below, above = np.empty((2, singular.sum(), _NRATES))
+        _fill_rate_table(voltages[singular] - 1e-6, below)
+        _fill_rate_table(voltages[singular] + 1e-6, above)
+        table[singular] = (below + above) / 2
+    table.flags.writeable = False
+    return table, float(v_min), 1 / resolution
 
-    def _update_soma(iv_trace, at):
-        'Perform a single soma timestep update'
-        nonlocal V_soma, soma_k, soma_l, soma_h, soma_n, soma_x
+# Passed to the kernels to evaluate the rate functions exactly
+_exact_rates = (np.empty((0, _NRATES)), 0., 0.)
+# Read-only like rate_table(), so both share a single kernel specialization
+_exact_rates[0].flags.writeable = False
 
-        # CURRENT: Soma leak current (ls)
-        soma_I_leak        = g_ls * (V_soma - V_l)
+def rates(lut_resolution=None):
+    'Rate table argument for the kernels, exact rates when lut_resolution is None'
+    return _exact_rates if lut_resolution is None else rate_table(lut_resolution)
 
-        # CURRENT: Soma interaction current (ds, as)
-        I_ds        =  (g_int / p1)        * (V_soma - V_dend)
-        I_as        =  (g_int / (1 - p2))  * (V_soma - V_axon)
-        soma_I_interact =  I_ds + I_as
+@numba.njit(fastmath=False, cache=True)
+def _rate_table_error(lut, voltages):
+    error = np.zeros(_NRATES)
+    for V in voltages:
+        exact = _soma_rates(V) + _axon_rates(V) + _dend_rates(V)
+        approx = _soma_rates_lut(lut, V) + _axon_rates_lut(lut, V) + _dend_rates_lut(lut, V)
+        for j in range(_NRATES):
+            error[j] = max(error[j], abs(exact[j] - approx[j]))
+    return error
 
-        # CHANNEL: Soma Low-threshold calcium (CaL)
-        soma_Ical   = g_CaL * soma_k * soma_k * soma_k * soma_l * (V_soma - V_Ca)
+def rate_table_error(resolution=0.05, v_min=-100., v_max=60.):
+    '''Maximum absolute error of the interpolated rates against the exact ones
 
-        soma_k_inf  = 1 / (1 + np.exp(-(V_soma + 61)/4.2))
-        soma_l_inf  = 1 / (1 + np.exp( (V_soma + 85)/8.5))
-        soma_tau_l  = (20 * np.exp((V_soma + 160)/30) / (1 + np.exp((V_soma + 84) / 7.3))) + 35
+    Sampled halfway between the table points over [v_min, v_max], where linear
+    interpolation is least accurate. Returns one value per rate table column.'''
+    lut = rate_table(resolution)
+    table, table_v_min, _inv_dv = lut
+    voltages = table_v_min + resolution * (np.arange(len(table) - 1) + 0.5)
+    voltages = voltages[(voltages >= v_min) & (voltages <= v_max)]
+    voltages = voltages[~np.isin(voltages.round(9), _removable_singularities)]
+    return _rate_table_error(lut, voltages)
 
-        soma_dk_dt  = soma_k_inf - soma_k
-        soma_dl_dt  = (soma_l_inf - soma_l) / soma_tau_l
+# Counter-based noise streams (SplitMix64 outputs of key + counter), the
+# normal sample of a timestep only depends on the stream key and step number
+_GOLDEN_GAMMA = np.uint64(0x9E3779B97F4A7C15)
+_NOISE_BLOCK = 64
+_I_NOISE_AMP = list(params_default).index('I_noise_amp')
+
+@numba.njit(fastmath=False, cache=True, inline='always')
+def _mix64(z):
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+@numba.njit(fastmath=False, cache=True, inline='always')
+def _uniform(key, counter):
+    'Uniform sample in (0, 1] of a stream'
+    z = _mix64(key + counter * _GOLDEN_GAMMA)
+    return np.float64((z >> np.uint64(11)) + np.uint64(1)) * 2.0**-53
+
+@numba.njit(fastmath=False, cache=True, inline='always')
+def _normal_pair(key, pair):
+    'Box-Muller on the uniforms of counters 2 pair + 1 and 2 pair + 2'
+    c = np.uint64(2) * np.uint64(pair)
+    r = np.sqrt(-2 * np.log(_uniform(key, c + np.uint64(1))))
+    theta = 2 * np.pi * _uniform(key, c + np.uint64(2))
+    return r * np.cos(theta), r * np.sin(theta)
+
+@numba.njit(fastmath=False, cache=True)
+def _fill_noise(key, step, out):
+    '''Standard normal samples of steps step, step+1, ... of a stream
+
+    Pair p gives the samples of steps 2p and 2p+1, so any block of steps
+    reproduces the same values.'''
+    j = 0
+    if step % 2 == 1:
+        out[0] = _normal_pair(key, step // 2)[1]
+        j = 1
+    while j + 1 < len(out):
+        out[j], out[j+1] = _normal_pair(key, (step + j) // 2)
+        j += 2
+    if j < len(out):
+        out[j] = _normal_pair(key, (step + j) // 2)[0]
+
+@numba.njit(fastmath=False, cache=True)
+def _noise_keys(seed, first_stream, nstreams):
+    keys = np.empty(nstreams, dtype=np.uint64)
+    base = _mix64(seed)
+    for i in range(nstreams):
+        keys[i] = _mix64(base + (first_stream + np.uint64(i)) * _GOLDEN_GAMMA)
+    return keys
+
+def noise_keys(seed=None, nstreams=1, stream=0):
+    '''Keys of the noise streams stream, stream+1, ... for seed
+
+    Every cell draws its I_noise_amp noise from its own stream, so a cell gives
+    the same result alone or in any batch, chunking or thread count as long as
+    it has the same stream. A random seed is used when seed is None.'''
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    return _noise_keys(np.uint64(seed % 2**64), np.uint64(stream % 2**64), nstreams)
+
+@numba.njit(fastmath=False, cache=True, inline='always')
+def _relax(x, x_inf, delta_over_tau):
+    'Exact solution of dx/dt = (x_inf - x) / tau after delta with x_inf and tau held constant'
+    return x_inf + (x - x_inf) * np.exp(-delta_over_tau)
+
+@numba.njit(fastmath=False, cache=True, inline='always')
+def _exp_step(rate, delta):
+    'Effective timestep of exponential Euler for dV/dt = rate * (V_inf - V), tends to delta for small rate'
+    return -np.expm1(-rate * delta) / rate
+
+@numba.njit(fastmath=False, cache=True)
+def _timestep(state, params, values, record, t, delta, pulse_start, pulse_end, I_c, noise, lut, exponential):
+    '''Perform a single timestep update of all compartments of one cell
+
+    I_c is the dendritic coupling current, noise the standard normal sample
+    scaled by I_noise_amp. If record is set the recordable
+    variables (trace_names except t) are written to values. lut is a rate
+    table (see rates()), with an empty table the rates are computed exactly.
+    With exponential set all state variables are updated with exponential
+    Euler instead of forward Euler: each is advanced with the exact solution
+    of its equation linearised at the start of the step (Rush-Larsen for the
+    gates), the membrane potentials with the conductances held constant.'''
+    (g_int, p1, p2, g_CaL, g_h, g_K_Ca, g_ld, g_la, g_ls, S,
+     g_Na_s, g_Kdr_s, g_K_s, g_CaH, g_Na_a, g_K_a,
+     V_Na, V_K, V_Ca, V_h, V_l,
+     I_app, I_pulse10ms, I_noise_amp) = params
+    (V_soma, soma_k, soma_l, soma_h, soma_n, soma_x,
+     V_axon, axon_Sodium_h, axon_Potassium_x,
+     V_dend, dend_Ca2Plus, dend_Calcium_r, dend_Potassium_s, dend_Hcurrent_q) = state
+    use_lut = lut[0].shape[0] > 0
+
+    ## SOMA
+
+    # RATES: Soma gating
+    (soma_k_inf, soma_l_inf, soma_tau_l, soma_m_inf, soma_h_inf, soma_tau_h,
+     soma_n_inf, soma_tau_n, soma_x_inf, soma_tau_x_inv) = \
+        _soma_rates_lut(lut, V_soma) if use_lut else _soma_rates(V_soma)
+
+    # CURRENT: Soma leak current (ls)
+    soma_I_leak        = g_ls * (V_soma - V_l)
+
+    # CURRENT: Soma interaction current (ds, as)
+    I_ds        =  (g_int / p1)        * (V_soma - V_dend)
+    I_as        =  (g_int / (1 - p2))  * (V_soma - V_axon)
+    soma_I_interact =  I_ds + I_as
+
+    # CHANNEL: Soma Low-threshold calcium (CaL)
+    soma_g_CaL  = g_CaL * soma_k * soma_k * soma_k * soma_l
+    soma_Ical   = soma_g_CaL * (V_soma - V_Ca)
+
+    soma_dk_dt  = soma_k_inf - soma_k
+    soma_dl_dt  = (soma_l_inf - soma_l) / soma_tau_l
+    if exponential:
+        soma_k  = _relax(soma_k, soma_k_inf, delta)
+        soma_l  = _relax(soma_l, soma_l_inf, delta / soma_tau_l)
+    else:
         soma_k      = delta * soma_dk_dt + soma_k
         soma_l      = delta * soma_dl_dt + soma_l
 
-        # CHANNEL: Soma sodium (Na_s)
-        # watch out direct gate: m = m_inf
-        soma_m_inf  = 1 / (1 + np.exp(-(V_soma + 30)/5.5))
-        soma_h_inf  = 1 / (1 + np.exp( (V_soma + 70)/5.8))
-        soma_Ina    = g_Na_s * soma_m_inf**3 * soma_h * (V_soma - V_Na)
-        soma_tau_h  = 3 * np.exp(-(V_soma + 40)/33)
-        soma_dh_dt  = (soma_h_inf - soma_h) / soma_tau_h
+    # CHANNEL: Soma sodium (Na_s)
+    # watch out direct gate: m = m_inf
+    soma_g_Na   = g_Na_s * soma_m_inf**3 * soma_h
+    soma_Ina    = soma_g_Na * (V_soma - V_Na)
+    soma_dh_dt  = (soma_h_inf - soma_h) / soma_tau_h
+    if exponential:
+        soma_h  = _relax(soma_h, soma_h_inf, delta / soma_tau_h)
+    else:
         soma_h      = soma_h + delta * soma_dh_dt
 
-        # CHANNEL: Soma potassium, slow component (Kdr)
-        soma_Ikdr   = g_Kdr_s * soma_n**4 * (V_soma - V_K)
-        soma_n_inf  = 1 / ( 1 + np.exp(-(V_soma +  3)/10))
-        soma_tau_n  = 5 + (47 * np.exp( (V_soma + 50)/900))
-        soma_dn_dt  = (soma_n_inf - soma_n) / soma_tau_n
+    # CHANNEL: Soma potassium, slow component (Kdr)
+    soma_g_Kdr  = g_Kdr_s * soma_n**4
+    soma_Ikdr   = soma_g_Kdr * (V_soma - V_K)
+    soma_dn_dt  = (soma_n_inf - soma_n) / soma_tau_n
+    if exponential:
+        soma_n  = _relax(soma_n, soma_n_inf, delta / soma_tau_n)
+    else:
         soma_n      = delta * soma_dn_dt + soma_n
 
-        # CHANNEL: Soma potassium, fast component (K_s)
-        soma_Ik      = g_K_s * soma_x**4 * (V_soma - V_K)
-        soma_alpha_x = 0.13 * (V_soma + 25) / (1 - np.exp(-(V_soma + 25)/10))
-        soma_beta_x  = 1.69 * np.exp(-(V_soma + 35)/80)
-        soma_tau_x_inv=soma_alpha_x + soma_beta_x
-        soma_x_inf   = soma_alpha_x / soma_tau_x_inv
-
-        soma_dx_dt   = (soma_x_inf - soma_x) * soma_tau_x_inv
+    # CHANNEL: Soma potassium, fast component (K_s)
+    soma_g_K     = g_K_s * soma_x**4
+    soma_Ik      = soma_g_K * (V_soma - V_K)
+    soma_dx_dt   = (soma_x_inf - soma_x) * soma_tau_x_inv
+    if exponential:
+        soma_x  = _relax(soma_x, soma_x_inf, delta * soma_tau_x_inv)
+    else:
         soma_x       = delta * soma_dx_dt + soma_x
 
-        # RECORD: Soma variables
-        if at >= 0:
-            iv_trace[at, 0] = soma_Ik
-            iv_trace[at, 1] = soma_Ikdr
-            iv_trace[at, 2] = soma_Ina
-            iv_trace[at, 3] = soma_Ical
-            iv_trace[at, 4] = V_soma
-
-        # UPDATE: Soma compartment update (V_soma)
-        soma_I_Channels = soma_Ik + soma_Ikdr + soma_Ina + soma_Ical
-        soma_dv_dt = S * (-(soma_I_leak + soma_I_interact + soma_I_Channels))
+    # RECORD: Soma variables
+    if record:
+        values[0] = soma_Ik
+        values[1] = soma_Ikdr
+        values[2] = soma_Ina
+        values[3] = soma_Ical
+        values[4] = V_soma
+
+    # UPDATE: Soma compartment update (V_soma)
+    soma_I_Channels = soma_Ik + soma_Ikdr + soma_Ina + soma_Ical
+    soma_dv_dt = S * (-(soma_I_leak + soma_I_interact + soma_I_Channels))
+    if exponential:
+        soma_G = g_ls + g_int / p1 + g_int / (1 - p2) + soma_g_CaL + soma_g_Na + soma_g_Kdr + soma_g_K
+        V_soma = V_soma + soma_dv_dt * _exp_step(S * soma_G, delta)
+    else:
         V_soma = V_soma + soma_dv_dt * delta
 
-    def _update_axon(iv_trace, at):
-        'Perform a single axon hillock timestep update'
-        nonlocal V_axon, axon_Sodium_h, axon_Potassium_x
+    ## AXON HILLOCK
 
-        # CURRENT: Axon leak current (la)
-        axon_I_leak    =  g_la * (V_axon - V_l)
+    # RATES: Axon hillock gating
+    (axon_m_inf, axon_h_inf, axon_tau_h, axon_x_inf, axon_tau_x_inv) = \
+        _axon_rates_lut(lut, V_axon) if use_lut else _axon_rates(V_axon)
 
-        # CURRENT: Axon interaction current (sa)
-        I_sa           =  (g_int / p2) * (V_axon - V_soma)
-        axon_I_interact=  I_sa
+    # CURRENT: Axon leak current (la)
+    axon_I_leak    =  g_la * (V_axon - V_l)
 
-        # CHANNEL: Axon sodium (Na_a)
-        # watch out direct gate: m = m_inf
-        axon_m_inf     =  1 / (1 + np.exp(-(V_axon+30)/5.5))
-        axon_h_inf     =  1 / (1 + np.exp( (V_axon+60)/5.8))
-        axon_Ina       =  g_Na_a * axon_m_inf**3 * axon_Sodium_h * (V_axon - V_Na)
-        axon_tau_h     =  1.5 * np.exp(-(V_axon+40)/33)
-        axon_dh_dt     =  (axon_h_inf - axon_Sodium_h) / axon_tau_h
+    # CURRENT: Axon interaction current (sa)
+    I_sa           =  (g_int / p2) * (V_axon - V_soma)
+    axon_I_interact=  I_sa
+
+    # CHANNEL: Axon sodium (Na_a)
+    # watch out direct gate: m = m_inf
+    axon_g_Na      =  g_Na_a * axon_m_inf**3 * axon_Sodium_h
+    axon_Ina       =  axon_g_Na * (V_axon - V_Na)
+    axon_dh_dt     =  (axon_h_inf - axon_Sodium_h) / axon_tau_h
+    if exponential:
+        axon_Sodium_h  =  _relax(axon_Sodium_h, axon_h_inf, delta / axon_tau_h)
+    else:
         axon_Sodium_h  =  axon_Sodium_h + delta * axon_dh_dt
 
-        # CHANNEL: Axon potassium (K_a)
-        axon_Ik        =  g_K_a * axon_Potassium_x**4 * (V_axon - V_K)
-        axon_alpha_x   =  0.13*(V_axon + 25) / (1 - np.exp(-(V_axon + 25)/10))
-        axon_beta_x    =  1.69 * np.exp(-(V_axon + 35)/80)
-        axon_tau_x_inv =  axon_alpha_x + axon_beta_x
-        axon_x_inf     =  axon_alpha_x / axon_tau_x_inv
-        axon_dx_dt     =  (axon_x_inf - axon_Potassium_x) * axon_tau_x_inv
+    # CHANNEL: Axon potassium (K_a)
+    axon_g_K       =  g_K_a * axon_Potassium_x**4
+    axon_Ik        =  axon_g_K * (V_axon - V_K)
+    axon_dx_dt     =  (axon_x_inf - axon_Potassium_x) * axon_tau_x_inv
+    if exponential:
+        axon_Potassium_x= _relax(axon_Potassium_x, axon_x_inf, delta * axon_tau_x_inv)
+    else:
         axon_Potassium_x= delta * axon_dx_dt + axon_Potassium_x
 
-        # RECORD: Axon variables
-        if at >= 0:
-            iv_trace[at, 5] = axon_Ina
-            iv_trace[at, 6] = axon_Ik
-            iv_trace[at, 7] = V_axon
+    # RECORD: Axon variables
+    if record:
+        values[5] = axon_Ina
+        values[6] = axon_Ik
+        values[7] = V_axon
 
-        # UPDATE: Axon hillock compartment update (V_axon)
-        axon_I_Channels = axon_Ina + axon_Ik
-        dv_dt  = S * (-(axon_I_leak +  axon_I_interact + axon_I_Channels))
+    # UPDATE: Axon hillock compartment update (V_axon)
+    axon_I_Channels = axon_Ina + axon_Ik
+    dv_dt  = S * (-(axon_I_leak +  axon_I_interact + axon_I_Channels))
+    if exponential:
+        axon_G = g_la + g_int / p2 + axon_g_Na + axon_g_K
+        V_axon = V_axon + dv_dt * _exp_step(S * axon_G, delta)
+    else:
         V_axon = V_axon + dv_dt * delta
 
-    def _update_dend(iv_trace, at, t):
-        'Perform a single denrite timestep update'
-        nonlocal V_dend, dend_Ca2Plus, dend_Calcium_r, dend_Potassium_s, dend_Hcurrent_q
+    ## DENDRITE
+
+    # RATES: Dend gating
+    (dend_r_inf, dend_tau_r_inv5, q_inf, tau_q_inv) = \
+        _dend_rates_lut(lut, V_dend) if use_lut else _dend_rates(V_dend)
 
-        # CURRENT: Dend application current (I_app, I_pulse10ms)
-        dend_I_application = -I_app + (-I_pulse10ms if \
-                 200 * sim_seconds < t - 1000 * skip_initial_transient_seconds < 210 * sim_seconds \
-                else 0) + I_noise_amp * 5 * np.random.normal(0, 1)
+    # CURRENT: Dend application current (I_app, I_pulse10ms)
+    dend_I_application = -I_app + (-I_pulse10ms if pulse_start < t < pulse_end \
+            else 0) + I_noise_amp * 5 * noise
 
-        # CURRENT: Dend leak current (ld)
-        dend_I_leak     =  g_ld * (V_dend - V_l)
+    # CURRENT: Dend leak current (ld)
+    dend_I_leak     =  g_ld * (V_dend - V_l)
 
-        # CURRENT: Dend interaction Current (sd)
-        dend_I_interact =  (g_int / (1 - p1)) * (V_dend - V_soma)
+    # CURRENT: Dend interaction Current (sd)
+    dend_I_interact =  (g_int / (1 - p1)) * (V_dend - V_soma)
 
-        # CHANNEL: Dend high-threshold calcium (CaH)
-        dend_Icah       =  g_CaH * dend_Calcium_r * dend_Calcium_r * (V_dend - V_Ca)
-        dend_alpha_r    =  1.7 / (1 + np.exp(-(V_dend - 5)/13.9))
-        dend_beta_r     =  0.02*(V_dend + 8.5) / (np.exp((V_dend + 8.5)/5) - 1.0)
-        dend_tau_r_inv5 =  (dend_alpha_r + dend_beta_r) # tau = 5 / (alpha + beta)
-        dend_r_inf      =  dend_alpha_r / dend_tau_r_inv5
-        dend_dr_dt      =  (dend_r_inf - dend_Calcium_r) * dend_tau_r_inv5 * 0.2
+    # CHANNEL: Dend high-threshold calcium (CaH)
+    dend_g_CaH      =  g_CaH * dend_Calcium_r * dend_Calcium_r
+    dend_Icah       =  dend_g_CaH * (V_dend - V_Ca)
+    dend_dr_dt      =  (dend_r_inf - dend_Calcium_r) * dend_tau_r_inv5 * 0.2
+    if exponential:
+        dend_Calcium_r  =  _relax(dend_Calcium_r, dend_r_inf, delta * dend_tau_r_inv5 * 0.2)
+    else:
         dend_Calcium_r  =  delta * dend_dr_dt + dend_Calcium_r
 
-        # CHANNEL: Dend calcium dependent potassium (KCa)
-        dend_Ikca       =  g_K_Ca * dend_Potassium_s * (V_dend - V_K)
-        dend_alpha_s    =  (0.00002 * dend_Ca2Plus) * (0.00002 * dend_Ca2Plus < 0.01) + 0.01*(0.00002 * dend_Ca2Plus > 0.01)
-        dend_tau_s_inv  =  dend_alpha_s + 0.015
-        dend_s_inf      =  dend_alpha_s / dend_tau_s_inv
-        dend_ds_dt      =  (dend_s_inf - dend_Potassium_s) * dend_tau_s_inv
+    # CHANNEL: Dend calcium dependent potassium (KCa)
+    dend_g_KCa      =  g_K_Ca * dend_Potassium_s
+    dend_Ikca       =  dend_g_KCa * (V_dend - V_K)
+    dend_alpha_s    =  (0.00002 * dend_Ca2Plus) * (0.00002 * dend_Ca2Plus < 0.01) + 0.01*(0.00002 * dend_Ca2Plus > 0.01)
+    dend_tau_s_inv  =  dend_alpha_s + 0.015
+    dend_s_inf      =  dend_alpha_s / dend_tau_s_inv
+    dend_ds_dt      =  (dend_s_inf - dend_Potassium_s) * dend_tau_s_inv
+    if exponential:
+        dend_Potassium_s=  _relax(dend_Potassium_s, dend_s_inf, delta * dend_tau_s_inv)
+    else:
         dend_Potassium_s=  delta * dend_ds_dt + dend_Potassium_s
 
-        # CHANNEL: Dend proton (h)
-        dend_Ih         =  g_h * dend_Hcurrent_q * (V_dend - V_h)
-        q_inf           =  1 / (1 + np.exp((V_dend + 80)/4))
-        tau_q_inv       =  np.exp(-0.086*V_dend - 14.6) + np.exp(0.070*V_dend - 1.87)
-        dq_dt           =  (q_inf - dend_Hcurrent_q) * tau_q_inv
+    # CHANNEL: Dend proton (h)
+    dend_g_h        =  g_h * dend_Hcurrent_q
+    dend_Ih         =  dend_g_h * (V_dend - V_h)
+    dq_dt           =  (q_inf - dend_Hcurrent_q) * tau_q_inv
+    if exponential:
+        dend_Hcurrent_q =  _relax(dend_Hcurrent_q, q_inf, delta * tau_q_inv)
+    else:
         dend_Hcurrent_q =  delta * dq_dt + dend_Hcurrent_q
 
-        # CONCENTRATION: Dend calcium concentration (CaPlus)
-        dCa_dt          =  -3 * dend_Icah - 0.075 * dend_Ca2Plus
+    # CONCENTRATION: Dend calcium concentration (CaPlus)
+    dCa_dt          =  -3 * dend_Icah - 0.075 * dend_Ca2Plus
+    if exponential:
+        # Linear in the concentration with the calcium current held constant
+        dend_Ca2Plus    =  _relax(dend_Ca2Plus, -40 * dend_Icah, delta * 0.075)
+    else:
         dend_Ca2Plus    =  delta * dCa_dt + dend_Ca2Plus
 
-        # RECORD: Dend variables
-        if at >= 0:
-            iv_trace[at, 8] = dend_Icah
-            iv_trace[at, 9] = dend_Ikca
-            iv_trace[at, 10] = dend_Ih
-            iv_trace[at, 11] = V_dend
+    # RECORD: Dend variables
+    if record:
+        values[8] = dend_Icah
+        values[9] = dend_Ikca
+        values[10] = dend_Ih
+        values[11] = V_dend
 
-        # UPDATE: Dend compartment update (V_dend)
-        dend_I_Channels = dend_Icah + dend_Ikca + dend_Ih
-        dend_dv_dt  = S * (-(dend_I_leak +  dend_I_interact + dend_I_application + dend_I_Channels))
+    # UPDATE: Dend compartment update (V_dend)
+    dend_I_Channels = dend_Icah + dend_Ikca + dend_Ih
+    dend_dv_dt  = S * (-(dend_I_leak +  dend_I_interact + dend_I_application + dend_I_Channels + I_c))
+    if exponential:
+        # The applied and coupling currents are treated as constant
+        dend_G = g_ld + g_int / (1 - p1) + dend_g_CaH + dend_g_KCa + dend_g_h
+        V_dend = V_dend + dend_dv_dt * _exp_step(S * dend_G, delta)
+    else:
         V_dend = V_dend + dend_dv_dt * delta
 
-    # Initialize simulation
-    nepochs = int(sim_seconds*1000 / delta / record_every + .5)
-    iv_trace = np.empty((nepochs, 13))
-    nskip = int(1000 * skip_initial_transient_seconds / delta + 0.5)
-    t = 0
+    # Store state for the next timestep
+    state[0] = V_soma
+    state[1] = soma_k
+    state[2] = soma_l
+    state[3] = soma_h
+    state[4] = soma_n
+    state[5] = soma_x
+    state[6] = V_axon
+    state[7] = axon_Sodium_h
+    state[8] = axon_Potassium_x
+    state[9] = V_dend
+    state[10] = dend_Ca2Plus
+    state[11] = dend_Calcium_r
+    state[12] = dend_Potassium_s
+    state[13] = dend_Hcurrent_q
+
+_V_SOMA = trace_names.index('V_soma')
+
+# Decimation of the timesteps within an epoch, see recording()
+DECIMATE_POINT, DECIMATE_MEAN, DECIMATE_MINMAX = 0, 1, 2
+decimate_modes = dict(point=DECIMATE_POINT, mean=DECIMATE_MEAN, minmax=DECIMATE_MINMAX)
+
+@numba.njit(fastmath=False, cache=True, inline='always')
+def _record(iv_trace, at, i_ts, record_every, values, columns, decimate):
+    'Reduce the values of timestep i_ts of epoch at into the selected columns of the trace'
+    if decimate == DECIMATE_POINT:
+        if i_ts == record_every - 1:
+            for j in range(len(columns)):
+                iv_trace[at, j] = values[columns[j]]
+    elif decimate == DECIMATE_MEAN:
+        for j in range(len(columns)):
+            if i_ts == 0:
+                iv_trace[at, j] = values[columns[j]] / record_every
+            else:
+                iv_trace[at, j] += values[columns[j]] / record_every
+    else:
+        for j in range(len(columns)):
+            v = values[columns[j]]
+            if i_ts == 0 or v < iv_trace[2*at, j]:
+                iv_trace[2*at, j] = v
+            if i_ts == 0 or v > iv_trace[2*at+1, j]:
+                iv_trace[2*at+1, j] = v
+
+# Time integration schemes, see integration()
+INTEGRATE_EULER, INTEGRATE_EXPONENTIAL, INTEGRATE_ADAPTIVE = 0, 1, 2
+integration_methods = dict(euler=INTEGRATE_EULER, exponential=INTEGRATE_EXPONENTIAL, adaptive=INTEGRATE_ADAPTIVE)
+
+# Smallest adaptive step (ms), accepted regardless of the error estimate
+_MIN_ADAPTIVE_STEP = 1e-4
+
+@numba.njit(fastmath=False, cache=True)
+def _advance_adaptive(state, params, values, scratch, t, t_end, h, h_max, pulse_start, pulse_end, lut, tolerance):
+    '''Exponential Euler steps from t to t_end with step doubling error control
+
+    A step of h is compared to two steps of h/2, the halved result is kept if
+    the membrane potentials differ by at most tolerance (mV). Steps do not
+    cross the pulse edges. A non-finite error ends the steps with the
+    diverged state. Returns the step size to continue with, values holds
+    the recordable variables of the last step.'''
+    full, half = scratch[0], scratch[1]
+    while t_end - t > 1e-9:
+        step = min(h, t_end - t)
+        if t < pulse_start < t + step:
+            step = pulse_start - t
+        elif t < pulse_end < t + step:
+            step = pulse_end - t
+        full[:] = state
+        _timestep(full, params, values, False, t, step, pulse_start, pulse_end, 0., 0., lut, True)
+        half[:] = state
+        _timestep(half, params, values, False, t, step / 2, pulse_start, pulse_end, 0., 0., lut, True)
+        _timestep(half, params, values, True, t + step / 2, step / 2, pulse_start, pulse_end, 0., 0., lut, True)
+        error = max(abs(full[0] - half[0]), abs(full[6] - half[6]), abs(full[9] - half[9]))
+        if not np.isfinite(error):
+            # Diverged, keep the non-finite state like forward Euler does instead of shrinking h forever
+            state[:] = half
+            break
+        if error <= tolerance or step <= _MIN_ADAPTIVE_STEP:
+            state[:] = half
+            t += step
+        # Local error of a first order scheme grows with the square of the step
+        factor = 0.9 * np.sqrt(tolerance / error) if error > 0 else 2.
+        h = min(max(step * min(max(factor, 0.2), 2.), _MIN_ADAPTIVE_STEP), h_max)
+    return h
+
+@numba.njit(fastmath=False, cache=True, nogil=True)
+def _simulate_cell(state, params, iv_trace, columns, decimate, nskip, nepochs, record_every,
+        delta, t0, pulse_start, pulse_end, lut, method, tolerance, acc, feature_options, noise_key, step0):
+    '''Advance a single cell, state is updated in place, returns the final time
+
+    If acc is not empty (see iofeatures.accumulator) V_soma is added to it at
+    the end of every epoch, independent of what is recorded. The noise of
+    the first step is step0 of the noise stream noise_key (see noise_keys),
+    it is generated in blocks of _NOISE_BLOCK steps and only if I_noise_amp
+    is nonzero.'''
+    values = np.empty(len(trace_names))
+    t = t0
+
+    if method == INTEGRATE_ADAPTIVE:
+        # Epochs end at the same times as with fixed steps of delta, steps are at most one epoch
+        scratch = np.empty((2, len(state)))
+        h = _advance_adaptive(state, params, values, scratch, t, t0 + nskip * delta,
+                              delta, record_every * delta, pulse_start, pulse_end, lut, tolerance)
+        t = t0 + nskip * delta
+        for i_epoch in range(nepochs):
+            t_end = t0 + (nskip + (i_epoch + 1) * record_every) * delta
+            h = _advance_adaptive(state, params, values, scratch, t, t_end,
+                                  h, record_every * delta, pulse_start, pulse_end, lut, tolerance)
+            t = t_end
+            values[-1] = t
+            _record(iv_trace, i_epoch, record_every - 1, record_every, values, columns, decimate)
+            if len(acc) > 0:
+                iofeatures._update(acc, values[_V_SOMA], t, feature_options)
+        return t
+
+    exponential = method == INTEGRATE_EXPONENTIAL
+    noisy = params[_I_NOISE_AMP] != 0
+    noise = np.zeros(_NOISE_BLOCK)
+    i_step = 0
 
     # Transient simulation loop
     for _i_skip in range(nskip):
-        _update_soma(iv_trace, -1)
-        _update_axon(iv_trace, -1)
-        _update_dend(iv_trace, -1, t)
+        if noisy and i_step % _NOISE_BLOCK == 0:
+            _fill_noise(noise_key, step0 + i_step, noise)
+        _timestep(state, params, values, False, t, delta, pulse_start, pulse_end, 0.,
+                  noise[i_step % _NOISE_BLOCK], lut, exponential)
         t += delta
+        i_step += 1
 
     # Recorded simulation loop
     for i_epoch in range(nepochs):
-        for _i_ts in range(record_every):
-            _update_soma(iv_trace, i_epoch)
-            _update_axon(iv_trace, i_epoch)
-            _update_dend(iv_trace, i_epoch, t)
+        for i_ts in range(record_every):
+            if noisy and i_step % _NOISE_BLOCK == 0:
+                _fill_noise(noise_key, step0 + i_step, noise)
+            _timestep(state, params, values, decimate != DECIMATE_POINT or i_ts == record_every - 1,
+                      t, delta, pulse_start, pulse_end, 0., noise[i_step % _NOISE_BLOCK], lut, exponential)
             t += delta
-        iv_trace[i_epoch, -1] = t
+            i_step += 1
+            values[-1] = t
+            _record(iv_trace, i_epoch, i_ts, record_every, values, columns, decimate)
+        if len(acc) > 0:
+            iofeatures._update(acc, values[_V_SOMA], t, feature_options)
+    return t
+
+@numba.njit(fastmath=False, cache=True, parallel=True, nogil=True)
+def _simulate_cells(state, params, iv_trace, columns, decimate, nskip, nepochs, record_every,
+        delta, t0, pulse_start, pulse_end, lut, method, tolerance, acc, feature_options, noise_keys, step0):
+    'Advance every cell (column of state and params) independently, one cell per core, returns the final times'
+    t = np.empty(state.shape[1])
+    for i_cell in numba.prange(state.shape[1]):
+        # Thread-local copies, the columns of the SoA arrays are strided and
+        # writing them every timestep would cause false sharing between cores
+        cell_state = state[:, i_cell].copy()
+        t[i_cell] = _simulate_cell(cell_state, params[:, i_cell].copy(), iv_trace[i_cell], columns, decimate,
+                                   nskip, nepochs, record_every, delta, t0, pulse_start, pulse_end, lut, method,
+                                   tolerance, acc[i_cell], feature_options, noise_keys[i_cell], step0)
+        state[:, i_cell] = cell_state
+    return t
+
+def kernel_signatures(dtype=np.float64):
+    '''Numba signatures of _simulate_cell and _simulate_cells for traces of dtype
+
+    The simulate functions always pass exactly these argument types, so a
+    kernel compiled (or loaded from the cache) once is never specialized again.'''
+    f8, i8 = numba.float64, numba.int64
+    value = numba.from_dtype(np.dtype(dtype))
+    lut = numba.types.Tuple((numba.types.Array(f8, 2, 'C', readonly=True), f8, f8))
+    options = numba.types.UniTuple(f8, 3)
+    timing = (i8, i8, i8, i8, f8, f8, f8, f8)
+    u8 = numba.uint64
+    cell = f8(f8[::1], f8[::1], value[:, ::1], i8[::1], *timing, lut, i8, f8, f8[::1], options, u8, i8)
+    cells = f8[::1](f8[:, ::1], f8[:, ::1], value[:, :, ::1], i8[::1], *timing, lut, i8, f8, f8[:, ::1], options,
+                    u8[::1], i8)
+    return cell, cells
+
+def precompile(dtypes=(np.float64, np.float32), batch=True):
+    'Compile (or load from the cache) the kernels for traces of dtypes ahead of the first simulation, with batch also the parallel one'
+    for dtype in dtypes:
+        cell, cells = kernel_signatures(dtype)
+        _simulate_cell.compile(cell.args)
+        if batch:
+            _simulate_cells.compile(cells.args)
+
+def _source_hash():
+    'Hash of the kernel sources, to detect an ahead-of-time module built from other sources'
+    h = hashlib.sha1()
+    for filename in ('iocell.py', 'iofeatures.py'):
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), filename), 'rb') as f:
+            h.update(f.read())
+    return int.from_bytes(h.digest()[:7], 'little')
+
+@functools.lru_cache
+def _aot_module():
+    'The ahead-of-time compiled kernels of build_aot.py, None when missing, stale or disabled by IOCELL_NO_AOT'
+    if os.environ.get('IOCELL_NO_AOT'):
+        return None
+    try:
+        import _iocell_aot
+    except ImportError:
+        return None
+    if _iocell_aot.source_hash() != _source_hash():
+        warnings.warn('_iocell_aot was built from other sources and is ignored, rerun build_aot.py')
+        return None
+    return _iocell_aot
+
+def _run_cell(state, params, iv_trace, columns, decimate, nskip, nepochs, record_every,
+        delta, t0, pulse_start, pulse_end, lut, method, tolerance, acc, feature_options, noise_key, step0):
+    '''Run _simulate_cell, through the ahead-of-time compiled module when available
+
+    Only on the main thread: the exported kernels hold the GIL, on a
+    background thread (the GUI worker) they would freeze the other threads,
+    while the JIT kernel releases it.'''
+    kernel = getattr(_aot_module(), f'simulate_cell_{iv_trace.dtype.name}', None)
+    if kernel is not None and iv_trace.flags.c_contiguous and threading.current_thread() is threading.main_thread():
+        return kernel(state, params, iv_trace, columns, decimate, nskip, nepochs, record_every,
+                      delta, t0, pulse_start, pulse_end, *lut, method, tolerance, acc, *feature_options,
+                      noise_key, step0)
+    return _simulate_cell(state, params, iv_trace, columns, decimate, nskip, nepochs, record_every,
+                          delta, t0, pulse_start, pulse_end, lut, method, tolerance, acc, feature_options,
+                          noise_key, step0)
+
+def _run_cell_profiled(profile, state, params, iv_trace, columns, decimate, nskip, nepochs, record_every,
+        delta, t0, pulse_start, pulse_end, lut, method, tolerance, acc, feature_options, noise_key, step0):
+    '''_run_cell with the transient and recorded phases timed separately into profile, see ioprofile.run
+
+    The phases are separate kernel calls, so adaptive steps restart from delta
+    after the transient. Steps are counted in timesteps of delta.'''
+    t = ioprofile.run(profile, 'transient', nskip, _run_cell,
+            state, params, iv_trace[:0], columns, decimate, nskip, 0, record_every,
+            delta, t0, pulse_start, pulse_end, lut, method, tolerance, acc, feature_options, noise_key, step0)
+    return ioprofile.run(profile, 'record', nepochs * record_every, _run_cell,
+            state, params, iv_trace, columns, decimate, 0, nepochs, record_every,
+            delta, t, pulse_start, pulse_end, lut, method, tolerance, acc, feature_options, noise_key, step0 + nskip)
+
+def nsteps(skip_initial_transient_seconds, sim_seconds, delta, record_every):
+    'Number of transient timesteps and recorded epochs'
+    nskip = int(1000 * skip_initial_transient_seconds / delta + 0.5)
+    nepochs = int(sim_seconds*1000 / delta / record_every + .5)
+    return nskip, nepochs
+
+def recording(record=None, decimate='point'):
+    '''Column indices into trace_names and decimation mode of a recording
+
+    record selects variables by name (default all of trace_names, in that
+    order). Each epoch of record_every timesteps is reduced to a single row
+    by taking the last timestep (point), the mean or, for minmax, to two rows
+    holding the minimum and maximum so the trace keeps its envelope.'''
+    if record is None:
+        record = trace_names
+    if isinstance(record, str):
+        raise TypeError('record should be a sequence of variable names')
+    for k in record:
+        if k not in trace_names:
+            raise ValueError(f'Unknown variable: {k}')
+    if decimate not in decimate_modes:
+        raise ValueError(f'Unknown decimation: {decimate}, should be one of {tuple(decimate_modes)}')
+    columns = np.array([trace_names.index(k) for k in record], dtype=np.int64)
+    return columns, decimate_modes[decimate]
+
+def integration(method='euler', decimate='point', params=None, tolerance=None):
+    '''Integration scheme constant for method
+
+    euler is forward Euler for all state variables. exponential is exponential
+    Euler (see _timestep), which remains stable at larger delta as the fast
+    gates and membrane time constants no longer limit the step size. adaptive
+    uses exponential Euler with a step size that is controlled by the
+    membrane potential error (tolerance, mV per step), delta then only sets the
+    epoch length and the first step. Adaptive steps require point decimation
+    and no noise current, as per-step noise is not defined for variable steps.'''
+    if method not in integration_methods:
+        raise ValueError(f'Unknown integration method: {method}, should be one of {tuple(integration_methods)}')
+    if method == 'adaptive':
+        if decimate != 'point':
+            raise ValueError('Adaptive integration only supports point decimation')
+        if params is not None and np.any(params[list(params_default).index('I_noise_amp')] != 0):
+            raise ValueError('Adaptive integration does not support I_noise_amp')
+        if tolerance is not None and not tolerance > 0:
+            raise ValueError(f'Adaptive integration needs a positive tolerance, got {tolerance}')
+    return integration_methods[method]
+
+def trace_rows(nepochs, decimate):
+    'Number of trace rows for nepochs epochs'
+    return 2 * nepochs if decimate_modes[decimate] == DECIMATE_MINMAX else nepochs
+
+def pulse_window(skip_initial_transient_seconds, sim_seconds):
+    'Start and end time (ms) of the I_pulse10ms current pulse'
+    start = 1000. * skip_initial_transient_seconds
+    return start + 200. * sim_seconds, start + 210. * sim_seconds
+
+def make_params(ncells=None, **params):
+    'Broadcast (array-valued) parameters to a (len(params_default), ncells) array'
+    for k in params:
+        if k not in params_default:
+            raise TypeError(f'Unknown parameter: {k}')
+    values = [np.asarray(params.get(k, v), dtype=np.float64) for k, v in params_default.items()]
+    shape = np.broadcast_shapes(*(v.shape for v in values))
+    if len(shape) > 1:
+        raise ValueError(f'Parameters should be scalars or 1d arrays, got shape {shape}')
+    if ncells is None:
+        ncells = shape[0] if shape else 1
+    return np.array([np.broadcast_to(v, (ncells,)) for v in values])
+
+def make_state(ncells=1, state=None):
+    '''Initial state as a (len(state_default), ncells) array
+
+    state may be a previously returned final state, either (len(state_default),)
+    for all cells or (len(state_default), ncells), it is copied and not modified.'''
+    if state is None:
+        state = np.array(list(state_default.values()))
+    state = np.asarray(state, dtype=np.float64)
+    if state.shape[0] != len(state_default):
+        raise ValueError(f'State should have {len(state_default)} variables, got shape {state.shape}')
+    if state.ndim == 1:
+        state = state[:, None]
+    return np.array(np.broadcast_to(state, (len(state_default), ncells)))
+
+# Version of the checkpoint format written by save_checkpoint
+CHECKPOINT_VERSION = 1
+
+def save_checkpoint(filename, state, t, step, params, noise_keys, run=None):
+    '''Write the state of a single cell or batch simulation to a checkpoint file (.npz)
+
+    state and params are (len(state_default),) and (len(params_default),)
+    for a single cell or have an extra ncells axis, t is the time (ms), step
+    the noise counter (timesteps since the start of the noise streams) and
+    noise_keys the (ncells,) noise stream keys. run is a dict describing the
+    run that wrote the checkpoint. The file is replaced atomically.'''
+    filename = os.fspath(filename)
+    with open(filename + '.tmp', 'wb') as f:
+        np.savez(f, version=CHECKPOINT_VERSION, state_names=np.array(state_names),
+                 params_names=np.array(list(params_default)), state=np.asarray(state, dtype=np.float64),
+                 t=float(t), step=int(step), params=np.asarray(params, dtype=np.float64),
+                 noise_keys=np.asarray(noise_keys, dtype=np.uint64), run=json.dumps(run or {}))
+    os.replace(filename + '.tmp', filename)
+
+def load_checkpoint(filename):
+    '''Read a checkpoint of save_checkpoint as a dict
+
+    Holds state, t, step, noise_keys and run as written, params maps every
+    params_default key to a float, or to an (ncells,) array for a batch. Pass
+    it (or its filename) as resume to start new runs from it.'''
+    with np.load(filename) as f:
+        version = int(f['version'])
+        if version > CHECKPOINT_VERSION:
+            raise ValueError(f'{filename} has checkpoint version {version}, '
+                             f'this version of iocell reads up to {CHECKPOINT_VERSION}')
+        if tuple(f['state_names']) != state_names or tuple(f['params_names']) != tuple(params_default):
+            raise ValueError(f'{filename} is a checkpoint of other model variables')
+        params = f['params']
+        return dict(
+                state=f['state'], t=float(f['t']), step=int(f['step']), noise_keys=f['noise_keys'],
+                params={k: float(v) if params.ndim == 1 else v for k, v in zip(params_default, params)},
+                run=json.loads(str(f['run'])))
+
+def _start(ncells, resume, state, seed, stream, params):
+    '''Parameters, state, time, noise counter and noise keys of ncells cells to start a run from
+
+    Without resume a run starts at t=0 from state (see make_state). With
+    resume, a checkpoint or its filename, it continues from the checkpointed
+    state, time and noise streams. params then override the checkpointed
+    parameters and a seed replaces the noise streams.'''
+    if resume is None:
+        params = make_params(ncells, **params)
+        return params, make_state(params.shape[1], state), 0., 0, noise_keys(seed, params.shape[1], stream)
+    if state is not None:
+        raise ValueError('Give either state or resume')
+    if not isinstance(resume, dict):
+        resume = load_checkpoint(resume)
+    params = make_params(ncells, **{**resume['params'], **params})
+    ncells = params.shape[1]
+    if seed is None:
+        keys = np.array(np.broadcast_to(resume['noise_keys'], (ncells,)))
+    else:
+        keys = noise_keys(seed, ncells, stream)
+    # Cast, so a checkpoint of an int time or numpy step does not compile another specialisation
+    return params, make_state(ncells, resume['state']), float(resume['t']), int(resume['step']), keys
+
+def simulate_batch(skip_initial_transient_seconds=0, sim_seconds=10, delta=0.025, record_every=20,
+        ncells=None, state=None, return_state=False, record=None, dtype=np.float64, decimate='point',
+        lut_resolution=None, method='euler', tolerance=1e-3, return_features=False, seed=None, stream=0,
+        resume=None, checkpoint=None, **params):
+    '''Simulate many independent cells in parallel
+
+    Any parameter in params_default may be an array with one value per cell.
+    Returns an (ncells, nepochs, len(record)) trace, see recording() for
+    record and decimate. The simulation starts from state (see make_state) or
+    state_default, with return_state=True the final (len(state_default),
+    ncells) state is returned as well. With lut_resolution (mV) the gating
+    rates are interpolated from a rate_table instead of computed exactly.
+    method and tolerance select the integration scheme, see integration().
+    With return_features=True the iofeatures of V_soma are computed online
+    from one sample per epoch and returned last, as a dict of (ncells,)
+    arrays. record=[] then avoids keeping any trace. The I_noise_amp noise of
+    cell i is stream + i of seed (see noise_keys), random when seed is None.
+
+    resume starts the run from a checkpoint instead, at its time and with
+    its parameters and noise unless overridden, see _start. A single cell
+    checkpoint is shared by all cells, give a seed for independent noise.
+    The final state is written to checkpoint (see save_checkpoint) if given,
+    see simulate_batch_chunks for checkpoints during long runs.'''
+    params, state, t0, step0, keys = _start(ncells, resume, state, seed, stream, params)
+    columns, mode = recording(record, decimate)
+    method = integration(method, decimate, params, tolerance)
+    nskip, nepochs = nsteps(skip_initial_transient_seconds, sim_seconds, delta, record_every)
+    iv_trace = np.empty((params.shape[1], trace_rows(nepochs, decimate), len(columns)), dtype=dtype)
+    acc = iofeatures.accumulator(params.shape[1], return_features)
+    pulse_start, pulse_end = pulse_window(skip_initial_transient_seconds, sim_seconds)
+    t = _simulate_cells(state, params, iv_trace, columns, mode, nskip, nepochs, record_every, float(delta), t0,
+                        t0 + pulse_start, t0 + pulse_end, rates(lut_resolution),
+                        method, float(tolerance), acc, iofeatures.options(), keys, step0)
+    if checkpoint is not None:
+        # Every cell takes the same steps, so they all end at the same time
+        save_checkpoint(checkpoint, state, t[0] if len(t) else t0, step0 + nskip + nepochs * record_every,
+                        params, keys)
+    result = (iv_trace,) + ((state,) if return_state else ()) + ((iofeatures.finalize(acc),) if return_features else ())
+    return result if len(result) > 1 else iv_trace
+
+def simulate(skip_initial_transient_seconds=0, sim_seconds=10, delta=0.025, record_every=20,
+        state=None, return_state=False, record=None, dtype=np.float64, decimate='point',
+        lut_resolution=None, method='euler', tolerance=1e-3, return_features=False, seed=None, stream=0,
+        profile=None, resume=None, checkpoint=None, **params):
+    '''Simulate a single cell, returns an (nepochs, len(record)) trace
+
+    With return_state=True the final (len(state_default),) state is returned as
+    well, pass it back as state to continue the simulation where it stopped.
+    return_features works as in simulate_batch, with scalar features. The
+    noise is that of the cell with the same seed and stream in simulate_batch.
+    Given a dict as profile, the wall time, timesteps and floating-point
+    exceptions of the transient and the recorded phase are added to it, see
+    ioprofile.run. resume and checkpoint work as in simulate_batch, for
+    checkpoints written during long runs see simulate_to_file.'''
+    params, state, t0, step0, keys = _start(1, resume, state, seed, stream, params)
+    params, state = params[:, 0], state[:, 0]
+    columns, mode = recording(record, decimate)
+    method = integration(method, decimate, params, tolerance)
+    nskip, nepochs = nsteps(skip_initial_transient_seconds, sim_seconds, delta, record_every)
+    iv_trace = np.empty((trace_rows(nepochs, decimate), len(columns)), dtype=dtype)
+    acc = iofeatures.accumulator(None, return_features)
+    pulse_start, pulse_end = pulse_window(skip_initial_transient_seconds, sim_seconds)
+    run = _run_cell if profile is None else functools.partial(_run_cell_profiled, profile)
+    t = run(state, params, iv_trace, columns, mode, nskip, nepochs, record_every, float(delta), t0,
+            t0 + pulse_start, t0 + pulse_end, rates(lut_resolution),
+            method, float(tolerance), acc, iofeatures.options(), keys[0], step0)
+    if checkpoint is not None:
+        save_checkpoint(checkpoint, state, t, step0 + nskip + nepochs * record_every, params, keys)
+    result = (iv_trace,) + ((state,) if return_state else ()) + ((iofeatures.finalize(acc),) if return_features else ())
+    return result if len(result) > 1 else iv_trace
+
+def _chunk_checkpoint(checkpoint, params, state, t0, step0, keys, nepochs, skip_initial_transient_seconds,
+        sim_seconds, delta, record_every, columns, decimate, lut_resolution, method, tolerance, seed, stream, **extra):
+    '''Where a chunked run starts, see simulate_chunks
+
+    Returns the run_info stored with every checkpoint (None without
+    checkpoint), the first and last epoch to run, and the state, t, step and
+    noise keys to run them from. Those are the given ones, or the stored ones
+    when checkpoint holds a checkpoint of the same run (the same settings,
+    extra and (len(params_default), ncells) params). A checkpoint of another
+    run raises a ValueError.'''
+    t, step, first = t0, step0, 0
+    # A single empty chunk when nothing is recorded, so the transient still runs
+    last = max(nepochs, 1)
+    if checkpoint is None:
+        return None, first, last, state, t, step, keys
+    run_info = dict(
+            skip_initial_transient_seconds=skip_initial_transient_seconds, sim_seconds=sim_seconds,
+            delta=delta, record_every=record_every, record=[trace_names[c] for c in columns],
+            decimate=decimate, lut_resolution=lut_resolution, method=method, tolerance=tolerance,
+            seed=None if seed is None else int(seed), stream=stream, t0=t0, step0=step0, **extra)
+    if os.path.exists(checkpoint):
+        stored = load_checkpoint(checkpoint)
+        first = stored['run'].pop('epoch', None)
+        if stored['run'] != run_info or not np.array_equal(make_params(params.shape[1], **stored['params']), params):
+            raise ValueError(f'{checkpoint} holds a checkpoint of another run')
+        # The first chunk includes the transient, so every checkpoint of the run is past it
+        state, t, step, keys, last = stored['state'], stored['t'], stored['step'], stored['noise_keys'], nepochs
+    return run_info, first, last, state, t, step, keys
+
+def simulate_chunks(skip_initial_transient_seconds=0, sim_seconds=10, delta=0.025, record_every=20,
+        chunk_epochs=1000, state=None, out=None, record=None, dtype=np.float64, decimate='point',
+        lut_resolution=None, method='euler', tolerance=1e-3, seed=None, stream=0, profile=None,
+        resume=None, checkpoint=None, **params):
+    '''Simulate a single cell and yield (iv_trace chunk, state) pairs
+
+    Chunks hold at most chunk_epochs recorded epochs. The chunks concatenated
+    are identical to the trace returned by simulate with the same seed
+    (adaptive steps restart from delta every chunk, so only approximately for
+    method='adaptive'). If out is given (for example a numpy.memmap with the
+    shape of the full trace) the chunks are written directly into it and the
+    yielded chunks are views of out, otherwise only a single chunk is kept in
+    memory at a time. profile accumulates over the chunks as in simulate,
+    resume works as in simulate_batch.
+
+    With checkpoint the state after every chunk is written to that file. If
+    it already holds a checkpoint of the same run (same arguments), the run
+    continues after the last checkpointed chunk and only the remaining chunks
+    are yielded, a checkpoint of another run raises a ValueError.'''
+    params, state, t0, step0, keys = _start(1, resume, state, seed, stream, params)
+    params, state = params[:, 0], state[:, 0]
+    columns, mode = recording(record, decimate)
+    method_name, method = method, integration(method, decimate, params, tolerance)
+    nskip, nepochs = nsteps(skip_initial_transient_seconds, sim_seconds, delta, record_every)
+    shape = (trace_rows(nepochs, decimate), len(columns))
+    if out is not None and out.shape != shape:
+        raise ValueError(f'Output should have shape {shape}, got {out.shape}')
+    pulse_start, pulse_end = pulse_window(skip_initial_transient_seconds, sim_seconds)
+    lut = rates(lut_resolution)
+    acc = iofeatures.accumulator(None, False)
+    run = _run_cell if profile is None else functools.partial(_run_cell_profiled, profile)
+    run_info, first, last, state, t, step, keys = _chunk_checkpoint(
+            checkpoint, params[:, None], state, t0, step0, keys, nepochs, skip_initial_transient_seconds,
+            sim_seconds, delta, record_every, columns, decimate, lut_resolution, method_name, tolerance, seed, stream)
+    for start in range(first, last, chunk_epochs):
+        stop = min(start + chunk_epochs, nepochs)
+        rows = slice(trace_rows(start, decimate), trace_rows(stop, decimate))
+        if out is None:
+            iv_trace = np.empty((rows.stop - rows.start, len(columns)), dtype=dtype)
+        else:
+            iv_trace = out[rows]
+        chunk_nskip = nskip if start == 0 else 0
+        t = run(state, params, iv_trace, columns, mode, chunk_nskip,
+                stop - start, record_every, float(delta), t, t0 + pulse_start, t0 + pulse_end, lut,
+                method, float(tolerance), acc, iofeatures.options(), keys[0], step)
+        step += chunk_nskip + (stop - start) * record_every
+        if checkpoint is not None:
+            if isinstance(out, np.memmap):
+                # Epochs covered by a checkpoint should be on disk
+                out.flush()
+            save_checkpoint(checkpoint, state, t, step, params, keys, dict(run_info, epoch=stop))
+        yield iv_trace, state.copy()
+
+def simulate_batch_chunks(skip_initial_transient_seconds=0, sim_seconds=10, delta=0.025, record_every=20,
+        chunk_epochs=1000, ncells=None, state=None, record=None, dtype=np.float64, decimate='point',
+        lut_resolution=None, method='euler', tolerance=1e-3, seed=None, stream=0,
+        resume=None, checkpoint=None, **params):
+    '''Simulate many cells in parallel and yield (iv_trace chunk, state) pairs
+
+    The batch counterpart of simulate_chunks, chunks are (ncells, rows,
+    len(record)) and the state is (len(state_default), ncells). The chunks
+    concatenated along axis 1 are identical to the trace of simulate_batch
+    with the same seed. With checkpoint the state after every chunk is
+    written to that file and running again with the same arguments continues
+    after the last checkpointed chunk, as in simulate_chunks.'''
+    params, state, t0, step0, keys = _start(ncells, resume, state, seed, stream, params)
+    columns, mode = recording(record, decimate)
+    method_name, method = method, integration(method, decimate, params, tolerance)
+    nskip, nepochs = nsteps(skip_initial_transient_seconds, sim_seconds, delta, record_every)
+    pulse_start, pulse_end = pulse_window(skip_initial_transient_seconds, sim_seconds)
+    lut = rates(lut_resolution)
+    acc = iofeatures.accumulator(params.shape[1], False)
+    run_info, first, last, state, t, step, keys = _chunk_checkpoint(
+            checkpoint, params, state, t0, step0, keys, nepochs, skip_initial_transient_seconds,
+            sim_seconds, delta, record_every, columns, decimate, lut_resolution, method_name, tolerance, seed, stream,
+            ncells=params.shape[1])
+    for start in range(first, last, chunk_epochs):
+        stop = min(start + chunk_epochs, nepochs)
+        iv_trace = np.empty((params.shape[1], trace_rows(stop - start, decimate), len(columns)), dtype=dtype)
+        chunk_nskip = nskip if start == 0 else 0
+        t_cells = _simulate_cells(state, params, iv_trace, columns, mode, chunk_nskip,
+                stop - start, record_every, float(delta), t, t0 + pulse_start, t0 + pulse_end, lut,
+                method, float(tolerance), acc, iofeatures.options(), keys, step)
+        t = t_cells[0] if len(t_cells) else t
+        step += chunk_nskip + (stop - start) * record_every
+        if checkpoint is not None:
+            save_checkpoint(checkpoint, state, t, step, params, keys, dict(run_info, epoch=stop))
+        yield iv_trace, state.copy()
+
+def simulate_to_file(filename, skip_initial_transient_seconds=0, sim_seconds=10, delta=0.025, record_every=20,
+        chunk_epochs=100000, state=None, return_state=False, record=None, dtype=np.float64, decimate='point',
+        lut_resolution=None, method='euler', tolerance=1e-3, seed=None, stream=0, profile=None,
+        resume=None, checkpoint=None, **params):
+    '''Simulate a single cell directly into a memory mapped .npy file
+
+    Memory use does not depend on sim_seconds. The file has its final size from
+    the start and can be opened with np.load(filename, mmap_mode='r') while the
+    simulation is running, epochs that are not yet simulated are zero.
 
-    # Return simulation results
-    return iv_trace
+    With checkpoint the state is checkpointed after every chunk, running
+    again with the same arguments after an interruption continues where the
+    last checkpoint was written (see simulate_chunks) in the existing file.'''
+    columns, _mode = recording(record, decimate)
+    _nskip, nepochs = nsteps(skip_initial_transient_seconds, sim_seconds, delta, record_every)
+    shape = (trace_rows(nepochs, decimate), len(columns))
+    final_state = None
+    if checkpoint is not None and os.path.exists(checkpoint):
+        if not os.path.exists(filename):
+            raise ValueError(f'{filename} is missing, remove {checkpoint} to start over')
+        out = np.lib.format.open_memmap(filename, mode='r+')
+        if out.shape != shape or out.dtype != dtype:
+            raise ValueError(f'{filename} holds another run')
+        # Already final when the run had finished
+        final_state = load_checkpoint(checkpoint)['state']
+    else:
+        out = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=shape)
+    for _iv_trace, final_state in simulate_chunks(skip_initial_transient_seconds, sim_seconds, delta, record_every,
+            chunk_epochs=chunk_epochs, state=state, out=out, record=record, decimate=decimate,
+            lut_resolution=lut_resolution, method=method, tolerance=tolerance, seed=seed, stream=stream,
+            profile=profile, resume=resume, checkpoint=checkpoint, **params):
+        out.flush()
+    if return_state:
+        return out, final_state
+    return out
 
 def main():
+    # Only the demo plots, importing pyplot takes longer than loading the kernels
+    import matplotlib.pyplot as plt
     for I_app in np.linspace(0, 1, 3):
         iv_trace = simulate(skip_initial_transient_seconds=1, sim_seconds=1, I_app=I_app)
         (soma_Ik, soma_Ikdr, soma_Ina, soma_Ical, V_soma,
@@ -0,0 +1,156 @@
+import numba
+import numpy as np
+
+# Features computed per trace, see features()
+feature_names = ('frequency', 'amplitude', 'V_mean', 'spike_count', 'burst_count', 'phase')
+
+# Defaults of the feature options (mV, ms, mV)
+spike_threshold = -20.
+burst_interval = 20.
+prominence = 5.
+
+# Layout of the running accumulator of a single trace
+(_MIN, _MAX, _SUM, _COUNT, _PREV, _SPIKES, _LAST_SPIKE, _RUN, _BURSTS,
+ _RISING, _EXT, _EXT_T, _PEAKS, _FIRST_PEAK, _LAST_PEAK, _T) = range(16)
+NACC = 16
+
+def options(spike_threshold=None, burst_interval=None, prominence=None):
+    'Feature options argument of the kernels, module defaults for None'
+    return (float(globals()['spike_threshold'] if spike_threshold is None else spike_threshold),
+            float(globals()['burst_interval'] if burst_interval is None else burst_interval),
+            float(globals()['prominence'] if prominence is None else prominence))
+
+@numba.njit(fastmath=False, cache=True, inline='always')
+def _reset(acc):
+    acc[:] = 0.
+    acc[_MIN] = np.inf
+    acc[_MAX] = -np.inf
+    acc[_PREV] = np.nan
+    acc[_LAST_SPIKE] = -np.inf
+
+@numba.njit(fastmath=False, cache=True, inline='always')
+def _update(acc, V, t, options):
+    'Add sample V at time t to a running accumulator'
+    threshold, max_interval, min_prominence = options
+    acc[_MIN] = min(acc[_MIN], V)
+    acc[_MAX] = max(acc[_MAX], V)
+    acc[_SUM] += V
+    acc[_COUNT] += 1
+
+    # Spikes are upward threshold crossings, a burst starts at the second
+    # spike within max_interval of the previous one
+    if acc[_PREV] < threshold <= V:
+        if t - acc[_LAST_SPIKE] <= max_interval:
+            acc[_RUN] += 1
+            if acc[_RUN] == 2:
+                acc[_BURSTS] += 1
+        else:
+            acc[_RUN] = 1
+        acc[_SPIKES] += 1
+        acc[_LAST_SPIKE] = t
+    acc[_PREV] = V
+
+    # Oscillation peaks: a maximum counts once V dropped min_prominence below
+    # it, after having risen min_prominence above the preceding minimum
+    if acc[_COUNT] == 1 or (acc[_RISING] and V > acc[_EXT]) or (not acc[_RISING] and V < acc[_EXT]):
+        acc[_EXT] = V
+        acc[_EXT_T] = t
+    elif acc[_RISING] and V < acc[_EXT] - min_prominence:
+        if acc[_PEAKS] == 0:
+            acc[_FIRST_PEAK] = acc[_EXT_T]
+        acc[_PEAKS] += 1
+        acc[_LAST_PEAK] = acc[_EXT_T]
+        acc[_RISING] = 0
+        acc[_EXT] = V
+        acc[_EXT_T] = t
+    elif not acc[_RISING] and V > acc[_EXT] + min_prominence:
+        acc[_RISING] = 1
+        acc[_EXT] = V
+        acc[_EXT_T] = t
+    acc[_T] = t
+
+@numba.njit(fastmath=False, cache=True, inline='always')
+def _finalize(acc, out):
+    'Write the features (feature_names order) of an accumulator to out'
+    if acc[_PEAKS] > 2:
+        period = (acc[_LAST_PEAK] - acc[_FIRST_PEAK]) / (acc[_PEAKS] - 1)
+        out[0] = 1000 / period
+        out[5] = 2 * np.pi * (((acc[_T] - acc[_LAST_PEAK]) / period) % 1)
+    else:
+        out[0] = 0.
+        out[5] = np.nan
+    # Also nan for diverged (nan) traces, which never update the extremes
+    out[1] = acc[_MAX] - acc[_MIN] if acc[_MAX] >= acc[_MIN] else np.nan
+    out[2] = acc[_SUM] / acc[_COUNT] if acc[_COUNT] > 0 else np.nan
+    out[3] = acc[_SPIKES]
+    out[4] = acc[_BURSTS]
+
+@numba.njit(fastmath=False, cache=True, parallel=True)
+def _features(V, t, options):
+    out = np.empty((V.shape[0], len(feature_names)))
+    for i in numba.prange(V.shape[0]):
+        acc = np.empty(NACC)
+        _reset(acc)
+        for j in range(V.shape[1]):
+            _update(acc, V[i, j], t[i, j], options)
+        _finalize(acc, out[i])
+    return out
+
+@numba.njit(fastmath=False, cache=True)
+def _reset_rows(acc):
+    for i in range(acc.shape[0]):
+        _reset(acc[i])
+
+@numba.njit(fastmath=False, cache=True)
+def _finalize_rows(acc):
+    out = np.empty((acc.shape[0], len(feature_names)))
+    for i in range(acc.shape[0]):
+        _finalize(acc[i], out[i])
+    return out
+
+def accumulator(ncells=None, enabled=True):
+    '''Running feature accumulators for online use in the simulation kernels
+
+    Shape (ncells, NACC), or (NACC,) for a single cell when ncells is None.
+    Disabled accumulators have length 0 in the last axis.'''
+    shape = (NACC,) if ncells is None else (ncells, NACC)
+    if not enabled:
+        return np.empty(shape[:-1] + (0,))
+    acc = np.empty(shape)
+    _reset_rows(acc.reshape(-1, NACC))
+    return acc
+
+def finalize(acc):
+    'Features of accumulators as a dict of arrays, or of floats for a single accumulator'
+    acc = np.asarray(acc)
+    out = _finalize_rows(acc.reshape(-1, NACC)).reshape(acc.shape[:-1] + (len(feature_names),))
+    if acc.ndim == 1:
+        return {k: float(v) for k, v in zip(feature_names, out)}
+    return dict(zip(feature_names, np.moveaxis(out, -1, 0)))
+
+def features(V, t, spike_threshold=None, burst_interval=None, prominence=None):
+    '''Oscillation features of one (nsamples,) or many (ntraces, nsamples) traces
+
+    t holds the sample times (ms), either per trace or shared. Returns a dict
+    with per trace:
+
+    frequency    peaks per second (Hz) over the detected oscillation peaks,
+                 0 when there are less than 3 peaks. A peak is a maximum with
+                 at least prominence mV rise before and fall after it
+    amplitude    peak to peak (mV)
+    V_mean       mean (mV)
+    spike_count  upward crossings of spike_threshold (mV)
+    burst_count  groups of spikes at most burst_interval (ms) apart
+    phase        oscillation phase (0 to 2 pi, 0 at a peak) at the last
+                 sample, nan when the frequency is 0
+
+    The options default to the module level values. The same features can be
+    computed online during a simulation with return_features=True.'''
+    V = np.asarray(V, dtype=np.float64)
+    single = V.ndim == 1
+    V = np.atleast_2d(V)
+    t = np.broadcast_to(np.asarray(t, dtype=np.float64), V.shape)
+    out = _features(V, t, options(spike_threshold, burst_interval, prominence))
+    if single:
+        return dict(zip(feature_names, out[0]))
+    return dict(zip(feature_names, out.T))
@@ -0,0 +1,407 @@
+import os
+import ast
+import sys
+import inspect
+import hashlib
+import textwrap
+import functools
+import collections
+import importlib.util
+
+import numpy as np
+
+import iocell
+import iofeatures
+
+# The kernels of iocell that are specialised. Their source is transformed,
+# so the model and its integration are only written once, in iocell.py
+kernel_functions = ('_timestep', '_advance_adaptive', '_simulate_cell', '_simulate_cells')
+
+# Rate functions of iocell that are inlined into _timestep, so the rates of
+# dropped channels are not computed
+rate_functions = ('_soma_rates', '_axon_rates', '_dend_rates')
+
+# Generated kernel modules are written here, numba caches their machine code
+# next to them. The least recently used modules are removed beyond
+# cache_bytes, at most loaded_kernels modules stay imported
+cache_dir = os.environ.get('IOMODEL_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'iolive', 'kernels'))
+cache_bytes = 2**28
+loaded_kernels = 16
+_loaded = collections.OrderedDict()
+
+_header = '''\
+# Generated by iomodel.py from the kernels of iocell, do not edit
+# iocell source {source_hash}, method {method}, frozen: {frozen}
+import numba
+import numpy as np
+
+{imports}
+'''
+
+@functools.lru_cache(maxsize=None)
+def _function_source(name):
+    return textwrap.dedent(inspect.getsource(getattr(iocell, name).py_func))
+
+def _function(name):
+    'The ast of the iocell kernel name, without its docstring'
+    node = ast.parse(_function_source(name)).body[0]
+    if isinstance(node.body[0], ast.Expr) and isinstance(node.body[0].value, ast.Constant):
+        node.body = node.body[1:]
+    return node
+
+def _zero(node):
+    return isinstance(node, ast.Constant) and type(node.value) in (int, float) and node.value == 0
+
+def _chain(node, op):
+    'Operands of a left associative chain of op, a + b + c gives a, b, c'
+    if isinstance(node, ast.BinOp) and isinstance(node.op, op):
+        return _chain(node.left, op) + [node.right]
+    return [node]
+
+def _evaluate(node):
+    'node as a constant when it can be evaluated'
+    try:
+        value = eval(compile(ast.fix_missing_locations(ast.Expression(node)), '<iomodel>', 'eval'), {})
+    except ArithmeticError:
+        return node
+    return ast.Constant(value) if type(value) in (bool, int, float) else node
+
+def _loads(node):
+    return {n.id for n in ast.walk(node) if isinstance(n, ast.Name) and isinstance(n.ctx, ast.Load)}
+
+def _stores(node):
+    return [n.id for n in ast.walk(node) if isinstance(n, ast.Name) and isinstance(n.ctx, ast.Store)]
+
+def _assign(name, value):
+    return ast.Assign([ast.Name(name, ast.Store())], value, lineno=0)
+
+class _Specialise(ast.NodeTransformer):
+    '''Substitute constants for names and fold what becomes constant
+
+    constants maps names to values, frozen the indices of the frozen
+    parameters to their values, which replace the unpacked parameters and
+    params[index]. Names assigned a constant only once become constants too,
+    branches on constants are removed. A product with a zero factor is zero
+    and zero terms are left out of sums, also with infinite or nan other
+    factors: this drops the channels and inputs of frozen zero parameters.'''
+
+    def __init__(self, constants, frozen):
+        self.constants = dict(constants)
+        self.frozen = frozen
+
+    def visit_FunctionDef(self, node):
+        self.once = {k for k, n in collections.Counter(_stores(node)).items() if n == 1}
+        self.generic_visit(node)
+        # Statements after a return that became unconditional
+        returns = [i for i, statement in enumerate(node.body) if isinstance(statement, ast.Return)]
+        if returns:
+            node.body = node.body[:returns[0] + 1]
+        return node
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, ast.Load) and node.id in self.constants:
+            return ast.Constant(self.constants[node.id])
+        return node
+
+    def visit_Subscript(self, node):
+        node = self.generic_visit(node)
+        if isinstance(node.ctx, ast.Load) and isinstance(node.value, ast.Name) and node.value.id == 'params' \
+                and isinstance(node.slice, ast.Constant) and node.slice.value in self.frozen:
+            return ast.Constant(self.frozen[node.slice.value])
+        return node
+
+    def visit_Assign(self, node):
+        target = node.targets[0]
+        if isinstance(target, ast.Tuple) and isinstance(node.value, ast.Name) and node.value.id == 'params':
+            unpacked = []
+            for i, name in enumerate(target.elts):
+                if i in self.frozen:
+                    self.constants[name.id] = self.frozen[i]
+                else:
+                    unpacked.append(_assign(name.id, ast.Subscript(ast.Name('params', ast.Load()), ast.Constant(i), ast.Load())))
+            return unpacked
+        if isinstance(target, ast.Name) and target.id in self.constants:
+            return None
+        node = self.generic_visit(node)
+        if isinstance(target, ast.Name) and target.id in self.once and isinstance(node.value, ast.Constant):
+            self.constants[target.id] = node.value.value
+            return None
+        return node
+
+    def visit_BinOp(self, node):
+        node = self.generic_visit(node)
+        if isinstance(node.op, ast.Mult) and any(_zero(factor) for factor in _chain(node, ast.Mult)):
+            return ast.Constant(0.)
+        if isinstance(node.op, ast.Add):
+            terms = [term for term in _chain(node, ast.Add) if not _zero(term)]
+            if not terms:
+                return ast.Constant(0.)
+            node = functools.reduce(lambda a, b: ast.BinOp(a, ast.Add(), b), terms)
+            if not isinstance(node, ast.BinOp):
+                return node
+        # No powers, numba computes integer powers differently from Python
+        if isinstance(node.op, (ast.Add, ast.Sub, ast.Mult, ast.Div)) and \
+                isinstance(node.left, ast.Constant) and isinstance(node.right, ast.Constant):
+            return _evaluate(node)
+        return node
+
+    def visit_UnaryOp(self, node):
+        node = self.generic_visit(node)
+        return _evaluate(node) if isinstance(node.operand, ast.Constant) else node
+
+    def visit_Compare(self, node):
+        node = self.generic_visit(node)
+        if all(isinstance(operand, ast.Constant) for operand in (node.left, *node.comparators)):
+            return _evaluate(node)
+        return node
+
+    def visit_BoolOp(self, node):
+        node = self.generic_visit(node)
+        deciding = isinstance(node.op, ast.Or)
+        values = []
+        for value in node.values:
+            if not isinstance(value, ast.Constant):
+                values.append(value)
+            elif bool(value.value) == deciding:
+                return ast.Constant(deciding)
+        if not values:
+            return ast.Constant(not deciding)
+        return values[0] if len(values) == 1 else ast.BoolOp(node.op, values)
+
+    def visit_IfExp(self, node):
+        node = self.generic_visit(node)
+        if isinstance(node.test, ast.Constant):
+            return node.body if node.test.value else node.orelse
+        if _zero(node.body) and _zero(node.orelse):
+            return ast.Constant(0.)
+        return node
+
+    def visit_If(self, node):
+        node = self.generic_visit(node)
+        if isinstance(node.test, ast.Constant):
+            return node.body if node.test.value else node.orelse
+        return node
+
+def _inline_rates(body):
+    'Statements of body with the calls of rate_functions replaced by their statements'
+    inlined = []
+    for node in body:
+        call = node.value if isinstance(node, ast.Assign) else None
+        if not (isinstance(call, ast.Call) and isinstance(call.func, ast.Name) and call.func.id in rate_functions):
+            inlined.append(node)
+            continue
+        function = _function(call.func.id)
+        for arg, value in zip(function.args.args, call.args):
+            if not (isinstance(value, ast.Name) and value.id == arg.arg):
+                inlined.append(_assign(arg.arg, value))
+        *statements, returned = function.body
+        inlined.extend(statements)
+        for target, value in zip(node.targets[0].elts, returned.value.elts):
+            if target.id != value.id:
+                inlined.append(_assign(target.id, value))
+    return inlined
+
+def _prune(body):
+    '''Statements of the _timestep body that affect the recorded values or the state they depend on
+
+    State variables that do not influence the recorded values (the gates of
+    dropped channels) are not stored, so they keep their value.'''
+    live = set()
+    while True:
+        needed, kept = set(), []
+        for node in reversed(body):
+            target = node.targets[0] if isinstance(node, ast.Assign) else None
+            if isinstance(target, ast.Subscript) and isinstance(target.value, ast.Name) and target.value.id == 'state':
+                keep = target.slice.value in live
+            elif isinstance(target, ast.Name):
+                keep = target.id in needed
+                needed.discard(target.id)
+            else:
+                keep = True
+            if keep:
+                kept.append(node)
+                needed |= _loads(node)
+        read = {iocell.state_names.index(k) for k in needed if k in iocell.state_names}
+        if read <= live:
+            return kept[::-1]
+        live |= read
+
+def _globals(function):
+    'Names function reads that are not its arguments or locals'
+    return _loads(function) - {arg.arg for arg in function.args.args} - set(_stores(function))
+
+def generate(frozen=None, method='euler'):
+    '''Source of a kernel module specialised for the frozen parameters and method
+
+    The kernel_functions of iocell with method (see iocell.integration) and
+    exact rates, frozen maps parameter names to the values that become
+    constants of the kernel. Channels with a frozen zero maximal conductance
+    and inputs with a frozen zero amplitude (I_app, I_pulse10ms, I_noise_amp)
+    are left out, without noise no random numbers are drawn. The module has
+    _simulate_cell and _simulate_cells with the arguments of the iocell
+    kernels.'''
+    frozen = {k: float(v) for k, v in (frozen or {}).items()}
+    for k, v in frozen.items():
+        if k not in iocell.params_default:
+            raise TypeError(f'Unknown parameter: {k}')
+        if not np.isfinite(v):
+            raise ValueError(f'Cannot freeze {k} at {v}')
+    if method not in iocell.integration_methods:
+        raise ValueError(f'Unknown integration method: {method}, should be one of {tuple(iocell.integration_methods)}')
+    index = list(iocell.params_default)
+    frozen_index = {index.index(k): v for k, v in frozen.items()}
+    module_constants = {k: v for k, v in vars(iocell).items() if k.lstrip('_').isupper() and type(v) in (int, float)}
+    constants = dict(
+            _timestep=dict(exponential=method != 'euler', use_lut=False, I_c=0.),
+            _simulate_cell=dict(method=iocell.integration_methods[method]))
+    functions = []
+    for name in kernel_functions:
+        function = _function(name)
+        local = {arg.arg for arg in function.args.args} | set(_stores(function))
+        inlined = {k: v for k, v in module_constants.items() if k not in local}
+        function = _Specialise({**inlined, **constants.get(name, {})}, frozen_index).visit(function)
+        if name == '_timestep':
+            function.body = _prune(_inline_rates(function.body))
+        functions.append(function)
+    used = sorted({k for function in functions for k in _globals(function)
+                   if k in vars(iocell) and k not in (*kernel_functions, 'np', 'numba')})
+    modules = [k for k in used if inspect.ismodule(getattr(iocell, k))]
+    imports = [f'import {k}' for k in modules] + \
+            [f'from iocell import {", ".join(k for k in used if k not in modules)}']
+    return _header.format(
+            source_hash=iocell._source_hash(), method=method,
+            frozen=', '.join(f'{k}={v!r}' for k, v in frozen.items()) or 'none',
+            imports='\n'.join(imports)) + ''.join(f'\n{ast.unparse(function)}\n' for function in functions)
+
+@functools.lru_cache(maxsize=256)
+def _generated(frozen, method):
+    return generate(dict(frozen), method)
+
+def kernels(frozen=(), method='euler'):
+    '''The generated kernel module for frozen, a tuple of (name, value) pairs, see generate
+
+    Modules are written to cache_dir under the hash of their source and
+    imported from there, so numba compiles every specialisation only once.'''
+    source = _generated(frozen, method)
+    name = f'_iomodel_{hashlib.sha1(source.encode()).hexdigest()[:16]}'
+    if name in _loaded:
+        _loaded.move_to_end(name)
+        return _loaded[name]
+    filename = os.path.join(cache_dir, f'{name}.py')
+    written = not os.path.exists(filename)
+    if written:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(f'{filename}.{os.getpid()}.tmp', 'w') as f:
+            f.write(source)
+        os.replace(f'{filename}.{os.getpid()}.tmp', filename)
+    else:
+        # Marks the module as recently used for evict()
+        os.utime(filename)
+    spec = importlib.util.spec_from_file_location(name, filename)
+    module = importlib.util.module_from_spec(spec)
+    # numba finds the module by name when it loads cached kernels
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    _loaded[name] = module
+    while len(_loaded) > loaded_kernels:
+        sys.modules.pop(_loaded.popitem(last=False)[0], None)
+    if written:
+        evict()
+    return module
+
+def evict():
+    'Remove the least recently used modules and their numba cache from cache_dir until it fits in cache_bytes'
+    pycache = os.path.join(cache_dir, '__pycache__')
+    sizes, used = {}, {}
+    for directory in (cache_dir, pycache):
+        if not os.path.isdir(directory):
+            continue
+        for entry in os.scandir(directory):
+            if not entry.name.startswith('_iomodel_'):
+                continue
+            name = entry.name.split('.')[0]
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            sizes[name] = sizes.get(name, 0) + stat.st_size
+            if directory == cache_dir and entry.name.endswith('.py'):
+                used[name] = stat.st_mtime
+    total = sum(sizes.values())
+    for name in sorted(sizes, key=lambda name: used.get(name, 0)):
+        if total <= cache_bytes:
+            break
+        if name in _loaded:
+            continue
+        for directory in (cache_dir, pycache):
+            if not os.path.isdir(directory):
+                continue
+            for entry in os.scandir(directory):
+                if entry.name.split('.')[0] == name:
+                    try:
+                        os.remove(entry.path)
+                    except FileNotFoundError:
+                        pass
+        total -= sizes[name]
+
+def frozen_params(params, freeze=None):
+    '''(name, value) pairs of the parameters to freeze of a (len(params_default), ncells) array
+
+    freeze names the parameters, which should have the same value for all
+    cells. None freezes the parameters that are zero for all cells, which
+    leaves out the channels and inputs they switch off, so the number of
+    specialisations stays small. Freeze other parameters only for long runs,
+    every new value compiles a new kernel.'''
+    same = {k: np.all(row == row[0]) for k, row in zip(iocell.params_default, params)}
+    if freeze is None:
+        freeze = [k for k, row in zip(iocell.params_default, params) if np.all(row == 0)]
+    for k in freeze:
+        if k not in iocell.params_default:
+            raise TypeError(f'Unknown parameter: {k}')
+        if not same[k]:
+            raise ValueError(f'Cannot freeze {k}, it differs between cells')
+    index = list(iocell.params_default)
+    return tuple((k, float(params[index.index(k), 0])) for k in iocell.params_default if k in freeze)
+
+def simulate_batch(skip_initial_transient_seconds=0, sim_seconds=10, delta=0.025, record_every=20,
+        ncells=None, state=None, return_state=False, record=None, dtype=np.float64, decimate='point',
+        method='euler', tolerance=1e-3, return_features=False, seed=None, stream=0, freeze=None, **params):
+    '''iocell.simulate_batch with a kernel specialised for the parameters in freeze (see frozen_params)
+
+    Results equal those of iocell.simulate_batch, except that the recorded
+    current of a dropped channel is zero and its gates are not advanced.
+    Every specialisation is compiled once (seconds) and then cached on disk,
+    so freezing values pays off for long runs with fixed parameters.
+    Supports every integration method with exact rates.'''
+    params, state, t0, step0, keys = iocell._start(ncells, None, state, seed, stream, params)
+    columns, mode = iocell.recording(record, decimate)
+    method_name, method = method, iocell.integration(method, decimate, params, tolerance)
+    module = kernels(frozen_params(params, freeze), method_name)
+    nskip, nepochs = iocell.nsteps(skip_initial_transient_seconds, sim_seconds, delta, record_every)
+    iv_trace = np.empty((params.shape[1], iocell.trace_rows(nepochs, decimate), len(columns)), dtype=dtype)
+    acc = iofeatures.accumulator(params.shape[1], return_features)
+    pulse_start, pulse_end = iocell.pulse_window(skip_initial_transient_seconds, sim_seconds)
+    module._simulate_cells(state, params, iv_trace, columns, mode, nskip, nepochs, record_every, float(delta), t0,
+                           t0 + pulse_start, t0 + pulse_end, iocell.rates(), method, float(tolerance), acc,
+                           iofeatures.options(), keys, step0)
+    result = (iv_trace,) + ((state,) if return_state else ()) + ((iofeatures.finalize(acc),) if return_features else ())
+    return result if len(result) > 1 else iv_trace
+
+def simulate(skip_initial_transient_seconds=0, sim_seconds=10, delta=0.025, record_every=20,
+        state=None, return_state=False, record=None, dtype=np.float64, decimate='point',
+        method='euler', tolerance=1e-3, return_features=False, seed=None, stream=0, freeze=None, **params):
+    'iocell.simulate with a specialised kernel, see simulate_batch and frozen_params'
+    params, state, t0, step0, keys = iocell._start(1, None, state, seed, stream, params)
+    columns, mode = iocell.recording(record, decimate)
+    method_name, method = method, iocell.integration(method, decimate, params, tolerance)
+    module = kernels(frozen_params(params, freeze), method_name)
+    params, state = params[:, 0], state[:, 0]
+    nskip, nepochs = iocell.nsteps(skip_initial_transient_seconds, sim_seconds, delta, record_every)
+    iv_trace = np.empty((iocell.trace_rows(nepochs, decimate), len(columns)), dtype=dtype)
+    acc = iofeatures.accumulator(None, return_features)
+    pulse_start, pulse_end = iocell.pulse_window(skip_initial_transient_seconds, sim_seconds)
+    module._simulate_cell(state, params, iv_trace, columns, mode, nskip, nepochs, record_every, float(delta), t0,
+                          t0 + pulse_start, t0 + pulse_end, iocell.rates(), method, float(tolerance), acc,
+                          iofeatures.options(), keys[0], step0)
+    result = (iv_trace,) + ((state,) if return_state else ()) + ((iofeatures.finalize(acc),) if return_features else ())
+    return result if len(result) > 1 else iv_trace
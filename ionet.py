@@ -0,0 +1,132 @@
+import numba
+import numpy as np
+import scipy.sparse
+
+import iocell
+import iofeatures
+
+_V_DEND = iocell.state_names.index('V_dend')
+
+# Relative work of a single cell timestep expressed in gap junctions,
+# used to balance the row partitions (about 20 exp() per cell, 1 per junction)
+_CELL_COST = 20
+
+# Shorter noise blocks than iocell, the network keeps one block per cell
+_NOISE_BLOCK = 16
+
+@numba.njit(fastmath=False, cache=True, inline='always')
+def _gap_junction_current(i, V_dend, indptr, indices, data):
+    'Voltage dependent gap junction current into dendrite i, O(row nnz)'
+    I_c = 0.
+    for k in range(indptr[i], indptr[i+1]):
+        vdiff = V_dend[i] - V_dend[indices[k]]
+        I_c += data[k] * (0.8 * np.exp(-vdiff*vdiff/100) + 0.2) * vdiff
+    return I_c
+
+@numba.njit(fastmath=False, cache=True, parallel=True, nogil=True)
+def _simulate_network(state, params, indptr, indices, data, partitions, record_row, iv_trace,
+        columns, decimate, nskip, nepochs, record_every, delta, t0, pulse_start, pulse_end, lut, exponential,
+        acc, feature_options, noise_keys):
+    '''Advance all cells in lockstep, each thread owns a contiguous block of CSR rows
+
+    With a non-empty acc the features of every cell are updated at the end of
+    every epoch, recorded or not. Cells with noise draw it from their stream
+    in noise_keys in blocks of _NOISE_BLOCK steps.'''
+    ncells = state.shape[1]
+    # Cell-major copies so every cell update touches contiguous memory
+    cell_state = np.ascontiguousarray(state.T)
+    cell_params = np.ascontiguousarray(params.T)
+    values = np.empty((len(partitions) - 1, len(iocell.trace_names)))
+    V_prev = np.empty(ncells)
+    noise = np.zeros((ncells, _NOISE_BLOCK))
+    t = t0
+    for i_step in range(nskip + nepochs * record_every):
+        at, i_ts = divmod(i_step - nskip, record_every)
+        record = i_step >= nskip and (decimate != iocell.DECIMATE_POINT or i_ts == record_every - 1)
+        track = i_step >= nskip and i_ts == record_every - 1 and acc.shape[1] > 0
+        # Coupling uses the dendritic voltages of the previous timestep
+        V_prev[:] = cell_state[:, _V_DEND]
+        for i_part in numba.prange(len(partitions) - 1):
+            part_values = values[i_part]
+            part_values[-1] = t + delta
+            for i in range(partitions[i_part], partitions[i_part+1]):
+                if i_step % _NOISE_BLOCK == 0 and cell_params[i, iocell._I_NOISE_AMP] != 0:
+                    iocell._fill_noise(noise_keys[i], i_step, noise[i])
+                I_c = _gap_junction_current(i, V_prev, indptr, indices, data)
+                row = record_row[i]
+                iocell._timestep(cell_state[i], cell_params[i], part_values, (record and row >= 0) or track,
+                        t, delta, pulse_start, pulse_end, I_c, noise[i, i_step % _NOISE_BLOCK], lut, exponential)
+                if record and row >= 0:
+                    iocell._record(iv_trace[row], at, i_ts, record_every, part_values, columns, decimate)
+                if track:
+                    iofeatures._update(acc[i], part_values[iocell._V_SOMA], t + delta, feature_options)
+        t += delta
+    state[:] = cell_state.T
+
+def partition_rows(indptr, nparts):
+    'Split CSR rows in nparts contiguous blocks of roughly equal cell + junction work'
+    ncells = len(indptr) - 1
+    cost = np.arange(ncells + 1) * _CELL_COST + indptr
+    bounds = np.searchsorted(cost, np.linspace(0, cost[-1], nparts + 1))
+    bounds[0], bounds[-1] = 0, ncells
+    return np.unique(bounds).astype(np.int64)
+
+def random_connectivity(ncells, connections_per_cell=10, g_gj=0.05, seed=None):
+    'Symmetric random gap junction conductance matrix (CSR) with about connections_per_cell per cell'
+    rng = np.random.default_rng(seed)
+    nhalf = ncells * connections_per_cell // 2
+    pre = rng.integers(0, ncells, nhalf)
+    post = rng.integers(0, ncells, nhalf)
+    keep = pre != post
+    pre, post = pre[keep], post[keep]
+    conn = scipy.sparse.coo_matrix(
+            (np.full(2*len(pre), g_gj), (np.concatenate([pre, post]), np.concatenate([post, pre]))),
+            shape=(ncells, ncells)).tocsr()
+    # Duplicate pairs are summed by tocsr(), keep a single junction
+    conn.data[:] = g_gj
+    return conn
+
+def simulate_network(connectivity, skip_initial_transient_seconds=0, sim_seconds=10, delta=0.025, record_every=20,
+        record_cells=None, nparts=None, state=None, return_state=False,
+        record=None, dtype=np.float64, decimate='point', lut_resolution=None, method='euler',
+        return_features=False, seed=None, **params):
+    '''Simulate a network of cells coupled by dendritic gap junctions
+
+    connectivity is an (ncells, ncells) sparse conductance matrix, entry (i, j)
+    couples the dendrite of cell i to that of cell j. Parameters may be arrays
+    with one value per cell as in iocell.simulate_batch. Only the cells in
+    record_cells (default all) are recorded, the returned trace has shape
+    (len(record_cells), nepochs, len(record)). state, return_state, record,
+    dtype, decimate, lut_resolution, method, return_features and seed work as
+    in iocell.simulate_batch, except that all cells share the timestep so
+    method='adaptive' is not supported. Features are computed for all cells,
+    also those not in record_cells.'''
+    conn = scipy.sparse.csr_matrix(connectivity, dtype=np.float64)
+    conn.sort_indices()
+    ncells = conn.shape[0]
+    if conn.shape != (ncells, ncells):
+        raise ValueError(f'Connectivity should be square, got shape {conn.shape}')
+    params = iocell.make_params(ncells, **params)
+    state = iocell.make_state(ncells, state)
+    record_cells = np.arange(ncells) if record_cells is None else np.asarray(record_cells, dtype=np.int64)
+    record_row = np.full(ncells, -1, dtype=np.int64)
+    record_row[record_cells] = np.arange(len(record_cells))
+    columns, mode = iocell.recording(record, decimate)
+    if method == 'adaptive':
+        raise ValueError('Adaptive integration is not supported for networks')
+    method = iocell.integration(method, decimate, params)
+    nskip, nepochs = iocell.nsteps(skip_initial_transient_seconds, sim_seconds, delta, record_every)
+    iv_trace = np.empty((len(record_cells), iocell.trace_rows(nepochs, decimate), len(columns)), dtype=dtype)
+    if nparts is None:
+        nparts = 4 * numba.get_num_threads()
+    partitions = partition_rows(conn.indptr.astype(np.int64), nparts)
+    acc = iofeatures.accumulator(ncells, return_features)
+    _simulate_network(state, params,
+            conn.indptr.astype(np.int64), conn.indices.astype(np.int64), conn.data,
+            partitions, record_row, iv_trace, columns, mode,
+            nskip, nepochs, record_every, float(delta), 0.,
+            *iocell.pulse_window(skip_initial_transient_seconds, sim_seconds),
+            iocell.rates(lut_resolution), method == iocell.INTEGRATE_EXPONENTIAL,
+            acc, iofeatures.options(), iocell.noise_keys(seed, ncells))
+    result = (iv_trace,) + ((state,) if return_state else ()) + ((iofeatures.finalize(acc),) if return_features else ())
+    return result if len(result) > 1 else iv_trace
@@ -0,0 +1,90 @@
+import json
+import time
+import ctypes
+import ctypes.util
+import platform
+import functools
+
+# Floating-point exception flags of <fenv.h> reported by fpe(), per architecture
+fpe_names = ('invalid', 'divbyzero', 'overflow', 'underflow')
+_fe_flags = {
+    'x86_64':  (0x01, 0x04, 0x08, 0x10),
+    'AMD64':   (0x01, 0x04, 0x08, 0x10),
+    'aarch64': (0x01, 0x02, 0x04, 0x08),
+    'arm64':   (0x01, 0x02, 0x04, 0x08),
+}
+
+@functools.lru_cache
+def _libm():
+    'The C math library when its floating-point status flags can be read, else None'
+    if platform.machine() not in _fe_flags:
+        return None
+    name = ctypes.util.find_library('m')
+    if name is None:
+        return None
+    try:
+        libm = ctypes.CDLL(name)
+    except OSError:
+        return None
+    return libm if hasattr(libm, 'fetestexcept') and hasattr(libm, 'feclearexcept') else None
+
+def clear_fpe():
+    'Clear the floating-point exception flags of the calling thread'
+    libm = _libm()
+    if libm is not None:
+        libm.feclearexcept(sum(_fe_flags[platform.machine()]))
+
+def fpe():
+    '''Names of the floating-point exceptions raised in the calling thread since clear_fpe()
+
+    These are the hardware flags, so they include the compiled kernels, which
+    do not follow np.seterr. None where the flags cannot be read.'''
+    libm = _libm()
+    if libm is None:
+        return None
+    raised = libm.fetestexcept(sum(_fe_flags[platform.machine()]))
+    return [k for k, flag in zip(fpe_names, _fe_flags[platform.machine()]) if raised & flag]
+
+def add(profile, key, value):
+    'Accumulate value into profile[key], lists are merged as sets'
+    if isinstance(value, list):
+        profile[key] = sorted(set(profile.get(key, [])) | set(value))
+    else:
+        profile[key] = profile.get(key, 0) + value
+
+def run(profile, phase, nsteps, f, *args):
+    '''Call f(*args) and add its wall time, steps and floating-point exceptions to profile
+
+    Adds {phase}_seconds, {phase}_steps and, where supported, fpe. The time
+    and exceptions are also added when f raises, the steps only on success.'''
+    clear_fpe()
+    start = time.perf_counter()
+    try:
+        result = f(*args)
+    finally:
+        add(profile, f'{phase}_seconds', time.perf_counter() - start)
+        raised = fpe()
+        if raised is not None:
+            add(profile, 'fpe', raised)
+    add(profile, f'{phase}_steps', nsteps)
+    return result
+
+def summary(profile):
+    'Single line description of a profile for display'
+    parts = []
+    for phase in ('transient', 'record', 'analysis', 'render', 'export'):
+        if f'{phase}_seconds' in profile:
+            parts.append(f'{phase} {1000 * profile[f"{phase}_seconds"]:.1f} ms')
+    if profile.get('cache_hits'):
+        parts.append('cached')
+    steps = profile.get('transient_steps', 0) + profile.get('record_steps', 0)
+    if steps:
+        parts.append(f'{steps} steps')
+    if 'fpe' in profile:
+        parts.append('FPE: ' + (', '.join(profile['fpe']) or 'none'))
+    return ' | '.join(parts)
+
+def log(filename, profile, **fields):
+    'Append a profile with extra fields and a timestamp as a JSON line to filename'
+    with open(filename, 'a') as f:
+        f.write(json.dumps(dict(time=time.time(), **profile, **fields)) + '\n')
@@ -1,20 +1,84 @@
+import os
 import sys
 import json
-import scipy.signal
+import time
 import numpy as np
 
 sys.path.append('/home/llandsmeer/Repos/notyet/iolive')
 sys.path.append('/home/llandsmeer/repos/llandsmeer/inferior_olive_live')
 
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QObject, QThread, QTimer, pyqtSignal, pyqtSlot
 from PyQt5.QtWidgets import QApplication, QWidget, QPushButton, QVBoxLayout, QHBoxLayout, QFormLayout, QSlider, QLabel, QTextEdit, QCheckBox, QComboBox
 from pyqtgraph import PlotWidget, plot
 import pyqtgraph as pg
 
 import iocell
+import iocache
+import iofeatures
+import ioprofile
 
 part = 0.2
 
+# Warm start: when parameters barely changed (as a fraction of the slider
+# range) continue from a previous state and skip most of the transient
+warm_tolerance = 0.02
+warm_transient_seconds = 0.1
+state_cache_size = 10000
+
+# Background simulation: slider events are coalesced for debounce_ms and the
+# trace is plotted progressively every chunk_epochs recorded epochs
+sim_seconds = 1
+delta = 0.025
+record_every = 4
+chunk_epochs = 1000
+debounce_ms = 5
+
+# Finished simulations are kept in an iocache.ResultCache, revisited
+# parameters are plotted from it instead of simulated again. Only the
+# parameters and the recording are part of the key, so a revisit shows the
+# same trace (and noise) as before, however it was warm started.
+# None for result_cache_dir keeps them in memory only
+result_cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'iolive')
+result_cache_memory_bytes = 2**27
+result_cache_disk_bytes = 2**28
+
+# With Profile checked every finished simulation appends its timings here
+profile_log = 'iolive_profile.jsonl'
+
+# Live mode: the simulation advances continuously in chunks, the last
+# live_window_seconds are kept in a ring buffer that is redrawn at live_fps.
+# A chunk covers the wall time since the previous one times the speed-up,
+# but at most live_max_lag_seconds, so a slow machine falls behind instead of
+# queueing work and parameter changes apply within one chunk
+live_window_seconds = 2
+live_fps = 30
+live_max_lag_seconds = 0.1
+live_speeds = {'1x': 1, '2x': 2, '5x': 5, '10x': 10, '50x': 50}
+
+# Dropdown entries and the iocell trace variable they plot
+draw_variables = {
+    'V(soma)':     'V_soma',
+    'V(dend)':     'V_dend',
+    'V(axon)':     'V_axon',
+    'I(k,soma)':   'soma_Ik',
+    'I(kdr,soma)': 'soma_Ikdr',
+    'I(na,soma)':  'soma_Ina',
+    'I(cal,soma)': 'soma_Ical',
+    'I(na,axon)':  'axon_Ina',
+    'I(k,axon)':   'axon_Ik',
+    'I(cah,dend)': 'dend_Icah',
+    'I(kca,dend)': 'dend_Ikca',
+    'I(h,dend)':   'dend_Ih',
+    'V(all)':      ('V_soma', 'V_dend', 'V_axon'),
+}
+
+# Curves are updated in place and min/max decimated to the view by pyqtgraph.
+# With Overlay checked the last overlay_runs finished runs stay visible in
+# overlay_pen, aligned to the start of the current run
+curve_pens = dict(V_soma='w', V_dend='c', V_axon='y')
+overlay_runs = 5
+overlay_pen = (150, 150, 150, 100)
+
 params_default = dict(
     g_int           =   0.13,    # Cell internal conductance  -- now a parameter (0.13)
     p1              =   0.25,    # Cell surface ratio soma/dendrite
@@ -42,16 +106,166 @@ params_default = dict(
     I_noise_amp     =  10.0
 )
 
+class RingBuffer:
+    'Fixed number of the most recent trace rows'
+
+    def __init__(self, nrows, ncolumns, dtype=np.float64):
+        self.data = np.empty((nrows, ncolumns), dtype=dtype)
+        self.end = 0
+        self.count = 0
+
+    def append(self, rows):
+        rows = rows[-len(self.data):]
+        first = min(len(rows), len(self.data) - self.end)
+        self.data[self.end:self.end+first] = rows[:first]
+        self.data[:len(rows)-first] = rows[first:]
+        self.end = (self.end + len(rows)) % len(self.data)
+        self.count = min(self.count + len(rows), len(self.data))
+
+    def ordered(self):
+        'The rows from oldest to newest'
+        if self.count < len(self.data):
+            return self.data[:self.count]
+        return np.concatenate([self.data[self.end:], self.data[:self.end]])
+
+def live_checkpoint(state):
+    'Checkpoint dict (see iocell.load_checkpoint) to start a live run from state, None for state_default'
+    return dict(state=iocell.make_state(1, state)[:, 0], t=0., step=0, noise_keys=iocell.noise_keys(), params={})
+
+class SimulationWorker(QObject):
+    'Runs simulations on a background thread, a newer generation cancels older runs'
+    partial = pyqtSignal(int, object, object)
+    finished = pyqtSignal(int, object, object, object, object)
+    failed = pyqtSignal(int, object, object)
+    advanced = pyqtSignal(int, object, object)
+
+    def __init__(self):
+        super().__init__()
+        # Written by the GUI thread, checked between chunks
+        self.generation = 0
+        self.cache = iocache.ResultCache(result_cache_dir, result_cache_memory_bytes, result_cache_disk_bytes)
+
+    @pyqtSlot()
+    def precompile(self):
+        'Load or compile the single cell kernel before the first simulation is requested'
+        iocell.precompile((np.float32,), batch=False)
+
+    @pyqtSlot(int, object, object, object, object)
+    def simulate(self, generation, params, state, record, profile):
+        'Simulate params from state, profile is None or a dict that collects ioprofile timings'
+        if generation != self.generation:
+            return
+        key = iocache.key(params, sim_seconds=sim_seconds, delta=delta, record_every=record_every,
+                          record=list(record), dtype='float32')
+        cached = self.cache.get(key)
+        if cached is not None:
+            if profile is not None:
+                ioprofile.add(profile, 'cache_hits', 1)
+            self.finished.emit(generation, params, cached['iv_trace'], cached['state'], profile)
+            return
+        nepochs = int(sim_seconds*1000 / delta / record_every + .5)
+        chunks = []
+        np.seterr(all='raise')
+        try:
+            for chunk, state in iocell.simulate_chunks(
+                    skip_initial_transient_seconds=1 if state is None else warm_transient_seconds,
+                    sim_seconds=sim_seconds,
+                    delta=delta,
+                    record_every=record_every,
+                    chunk_epochs=chunk_epochs,
+                    state=state,
+                    record=record,
+                    dtype=np.float32,
+                    profile=profile,
+                    **params):
+                if generation != self.generation:
+                    return
+                chunks.append(chunk)
+                if sum(map(len, chunks)) < nepochs:
+                    self.partial.emit(generation, params, np.concatenate(chunks))
+        except Exception as ex:
+            self.failed.emit(generation, ex, profile)
+            return
+        finally:
+            np.seterr(all='warn')
+        iv_trace = np.concatenate(chunks)
+        self.cache.put(key, dict(iv_trace=iv_trace, state=state))
+        self.finished.emit(generation, params, iv_trace, state, profile)
+
+    @pyqtSlot(int, object, object, int, object)
+    def advance(self, generation, params, resume, nepochs, record):
+        'Continue a live simulation from the checkpoint dict resume for nepochs epochs'
+        if generation != self.generation:
+            return
+        np.seterr(all='raise')
+        try:
+            iv_trace, state = iocell.simulate(
+                    sim_seconds=nepochs * record_every * delta / 1000,
+                    delta=delta,
+                    record_every=record_every,
+                    resume=resume,
+                    return_state=True,
+                    record=record,
+                    **params)
+        except Exception as ex:
+            self.failed.emit(generation, ex, None)
+            return
+        finally:
+            np.seterr(all='warn')
+        self.advanced.emit(generation, iv_trace, state)
+
 class Window(QWidget):
+    simulation_requested = pyqtSignal(int, object, object, object, object)
+    live_requested = pyqtSignal(int, object, object, int, object)
+
     def __init__(self):
         super().__init__()
         self.setStyleSheet('''
             background-color: #000000;
             color: #ffffff;
         ''')
+        self.last_params = None
+        self.last_state = None
+        self.state_cache = {}
+        self.params = None
+        self.record = None
+        self.generation = 0
+        # Profile of the simulation being plotted, None when not profiling
+        self.profile = None
+        self.export_seconds = 0.
+        self.selected = None
+        self.plotted = None
+        self.init_worker()
         self.init_ui()
         self.on_slider_update()
 
+    def init_worker(self):
+        self.worker = SimulationWorker()
+        self.worker_thread = QThread()
+        self.worker.moveToThread(self.worker_thread)
+        self.worker_thread.started.connect(self.worker.precompile)
+        self.simulation_requested.connect(self.worker.simulate)
+        self.worker.partial.connect(self.on_simulation_partial)
+        self.worker.finished.connect(self.on_simulation_finished)
+        self.worker.failed.connect(self.on_simulation_failed)
+        self.live_requested.connect(self.worker.advance)
+        self.worker.advanced.connect(self.on_live_advanced)
+        self.worker_thread.start()
+        self.live_timer = QTimer(self)
+        self.live_timer.setInterval(1000 // live_fps)
+        self.live_timer.timeout.connect(self.on_live_frame)
+        self.debounce_timer = QTimer(self)
+        self.debounce_timer.setSingleShot(True)
+        self.debounce_timer.setInterval(debounce_ms)
+        self.debounce_timer.timeout.connect(self.request_simulation)
+
+    def closeEvent(self, event):
+        self.live_timer.stop()
+        self.worker.generation = -1
+        self.worker_thread.quit()
+        self.worker_thread.wait()
+        super().closeEvent(event)
+
     def init_ui(self):
         self.sliders = {}
         self.slider_labels = {}
@@ -59,9 +273,21 @@ class Window(QWidget):
         self.setGeometry(100, 100, 800, 800)
         self.layout = QVBoxLayout()
         self.setLayout(self.layout)
+        pg.setConfigOption('foreground', 'w')
         self.graphWidget = pg.PlotWidget()
+        self.graphWidget.addLegend()
+        self.curves = {}
+        self.overlays = []
+        self.axes = None
         self.toplabel = QLabel('Loading...')
-        self.layout.addWidget(self.toplabel)
+        self.profile_label = QLabel()
+        self.profile_label.setAlignment(Qt.AlignRight)
+        self.profile_label.setStyleSheet('color: #aaaaaa;')
+        self.profile_label.hide()
+        top_layout = QHBoxLayout()
+        top_layout.addWidget(self.toplabel)
+        top_layout.addWidget(self.profile_label)
+        self.layout.addLayout(top_layout)
         self.layout.addWidget(self.graphWidget)
         slider_layout = QHBoxLayout()
         slider_layout_left = QFormLayout()
@@ -109,12 +335,7 @@ class Window(QWidget):
         settings_layout.addWidget(randomize_button)
         #
         self.draw_dropdown = QComboBox()
-        self.draw_dropdown.addItems([
-            'V(soma)', 'V(dend)', 'V(axon)', 
-            'I(k,soma)', 'I(kdr,soma)', 'I(na,soma)', 'I(cal,soma)',
-            'I(na,axon)', 'I(k,axon)',
-            'I(cah,dend)', 'I(kca,dend)', 'I(h,dend)'
-            ])
+        self.draw_dropdown.addItems(list(draw_variables))
         self.draw_dropdown.currentTextChanged.connect(self.on_slider_update)
         settings_layout.addWidget(self.draw_dropdown)
         #
@@ -123,6 +344,21 @@ class Window(QWidget):
         self.export_fmt_dropdown.currentTextChanged.connect(self.on_slider_update)
         settings_layout.addWidget(self.export_fmt_dropdown)
         #
+        self.profile_checkbox = QCheckBox('Profile')
+        self.profile_checkbox.toggled.connect(self.profile_label.setVisible)
+        settings_layout.addWidget(self.profile_checkbox)
+        #
+        self.live_checkbox = QCheckBox('Live')
+        self.live_checkbox.toggled.connect(self.on_live_toggled)
+        settings_layout.addWidget(self.live_checkbox)
+        self.live_speed_dropdown = QComboBox()
+        self.live_speed_dropdown.addItems(list(live_speeds))
+        settings_layout.addWidget(self.live_speed_dropdown)
+        #
+        self.overlay_checkbox = QCheckBox('Overlay')
+        self.overlay_checkbox.toggled.connect(self.on_overlay_toggled)
+        settings_layout.addWidget(self.overlay_checkbox)
+        #
         (slider_layout_left if i + 1 % 2 == 0 else slider_layout_right).addRow(settings_layout)
         # add a readonly multiline text edit
         self.textedit_params = QTextEdit()
@@ -152,10 +388,145 @@ class Window(QWidget):
         for k, v in params_default.items():
             params[k] = (1/part) * v * self.sliders[k].value() / self.sliders[k].maximum()
             self.slider_labels[k].setText(f'{k} ({params[k]:.3f})')
-        self.plot(**params)
+        start = time.perf_counter()
+        self.export(params)
+        self.export_seconds = time.perf_counter() - start
+        self.params = params
+        self.debounce_timer.start()
 
-    def plot(self, **params):
-        np.seterr(all='raise')
+    def selection(self):
+        'Plotted variables and the recording, only what is plotted and needed for the statistics'
+        selected = draw_variables[self.draw_dropdown.currentText()]
+        selected = (selected,) if isinstance(selected, str) else selected
+        return selected, tuple(dict.fromkeys([*selected, 'V_soma', 't']))
+
+    def request_simulation(self):
+        'Cancel any running simulation and start one for the current parameters'
+        if self.live_checkbox.isChecked():
+            # Live mode picks up the parameters at the next chunk
+            return
+        self.generation += 1
+        self.worker.generation = self.generation
+        if self.plotted is not None and self.overlay_checkbox.isChecked():
+            self.overlay(*self.plotted)
+        self.plotted = None
+        self.selected, self.record = self.selection()
+        profile = {} if self.profile_checkbox.isChecked() else None
+        self.simulation_requested.emit(self.generation, self.params, self.initial_state(self.params), self.record,
+                                       profile)
+
+    def on_simulation_partial(self, generation, params, iv_trace):
+        if generation == self.generation:
+            self.plot(params, iv_trace, final=False)
+
+    def on_simulation_finished(self, generation, params, iv_trace, state, profile):
+        if generation == self.generation:
+            self.store_state(params, state)
+            self.profile = profile
+            self.plot(params, iv_trace)
+            self.profile = None
+            if profile is not None:
+                self.report_profile(params, profile)
+
+    def on_simulation_failed(self, generation, ex, profile):
+        if generation == self.generation:
+            self.toplabel.setText(f'{repr(ex)}')
+            self.clear_plot()
+            if self.live_checkbox.isChecked():
+                # Restart from the default state at the next frame
+                self.start_live(live_checkpoint(None))
+            if profile is not None:
+                self.report_profile(self.params, dict(profile, error=repr(ex)))
+
+    def report_profile(self, params, profile):
+        'Show a profile in the overlay next to toplabel and append it to profile_log'
+        profile['export_seconds'] = self.export_seconds
+        text = ioprofile.summary(profile)
+        if 'error' in profile:
+            text += f' | {profile["error"]}'
+        self.profile_label.setText(text)
+        ioprofile.log(profile_log, profile, params=params, record=list(self.record))
+
+    def on_live_toggled(self, live):
+        if live:
+            self.start_live(live_checkpoint(self.last_state))
+            self.live_timer.start()
+        else:
+            self.live_timer.stop()
+            self.request_simulation()
+
+    def start_live(self, resume):
+        'Start plotting a live run that continues from the checkpoint dict resume'
+        self.generation += 1
+        self.worker.generation = self.generation
+        self.selected, self.record = self.selection()
+        self.live_resume = resume
+        self.live_buffer = RingBuffer(int(live_window_seconds * 1000 / delta / record_every), len(self.record))
+        self.live_busy = False
+        self.live_wall = time.perf_counter()
+        self.live_debt_ms = 0.
+        self.clear_plot()
+
+    def on_live_frame(self):
+        'Request the next chunk when the previous one is done, redraw the ring buffer'
+        if self.selection()[1] != self.record:
+            self.start_live(self.live_resume)
+        now = time.perf_counter()
+        if not self.live_busy:
+            speed = live_speeds[self.live_speed_dropdown.currentText()]
+            sim_ms = 1000 * min(now - self.live_wall, live_max_lag_seconds) * speed + self.live_debt_ms
+            nepochs = int(sim_ms / (delta * record_every))
+            if nepochs > 0:
+                self.live_debt_ms = sim_ms - nepochs * delta * record_every
+                self.live_wall = now
+                self.live_busy = True
+                # The current pulse is timed relative to a run and has no meaning for endless runs
+                params = dict(self.params, I_pulse10ms=0.)
+                self.live_requested.emit(self.generation, params, self.live_resume, nepochs, self.record)
+        self.plot_live()
+
+    def on_live_advanced(self, generation, iv_trace, state):
+        if generation != self.generation:
+            return
+        nsteps = len(iv_trace) * record_every
+        self.live_resume = dict(self.live_resume, state=state, t=self.live_resume['t'] + nsteps * delta,
+                                step=self.live_resume['step'] + nsteps)
+        self.live_buffer.append(iv_trace)
+        self.live_busy = False
+
+    def plot_live(self):
+        'Scroll the plot to the end of the ring buffer'
+        if self.live_buffer.count == 0:
+            return
+        trace = dict(zip(self.record, self.live_buffer.ordered().T))
+        t = trace['t']
+        self.show_trace(trace, self.selected, live=True)
+        self.graphWidget.setXRange(t[-1] - 1000 * live_window_seconds, t[-1], padding=0)
+        stats = iofeatures.features(trace['V_soma'], t)
+        self.toplabel.setText(f'{t[-1] / 1000:.1f} s, {stats["frequency"]:.1f} Hz, {stats["amplitude"]:.1f} mVpp')
+
+    def neighbourhood(self, params):
+        'Parameters rounded to a grid of warm_tolerance times the slider range'
+        return tuple(round(part * params[k] / abs(v) / warm_tolerance) for k, v in params_default.items())
+
+    def initial_state(self, params):
+        'Cached or previous state to warm start from, None if a full transient is needed'
+        state = self.state_cache.get(self.neighbourhood(params))
+        if state is not None:
+            return state
+        if self.last_params is None:
+            return None
+        distance = max(part * abs(params[k] - self.last_params[k]) / abs(v) for k, v in params_default.items())
+        return self.last_state if distance <= warm_tolerance else None
+
+    def store_state(self, params, state):
+        self.last_params = params
+        self.last_state = state
+        if len(self.state_cache) >= state_cache_size:
+            del self.state_cache[next(iter(self.state_cache))]
+        self.state_cache[self.neighbourhood(params)] = state
+
+    def export(self, params):
         export_params = {k: round(v, 8) for k, v in sorted(params.items()) if k != 'I_pulse10ms'}
         export_fmt = self.export_fmt_dropdown.currentIndex()
         if export_fmt == 0:
@@ -172,53 +543,86 @@ class Window(QWidget):
             self.textedit_params.setText(s)
         else:
             raise ValueError(f'Unknown export format: {export_fmt}')
-        try:
-            iv_trace = iocell.simulate(
-                    skip_initial_transient_seconds=1, sim_seconds=1,
-                    record_every=4,
-                    **params)
-        except Exception as ex:
-            self.toplabel.setText(f'{repr(ex)}')
-            self.graphWidget.clear()
+
+    def clear_plot(self):
+        'Remove all curves, including the overlaid runs'
+        self.graphWidget.clear()
+        self.curves = {}
+        self.overlays = []
+        self.axes = None
+
+    def add_curve(self, **kwargs):
+        'A curve drawn only within the view, min/max decimated to about one point pair per pixel'
+        curve = self.graphWidget.plot(**kwargs)
+        # Enabled after adding, pyqtgraph fails on these before the curve has a view
+        curve.setClipToView(True)
+        curve.setDownsampling(auto=True, method='peak')
+        return curve
+
+    def show_trace(self, trace, selected, live=False):
+        'Update the persistent curves of the selected variables in place'
+        for name in list(self.curves):
+            if name not in selected or self.curves[name].getViewBox() is None:
+                self.graphWidget.removeItem(self.curves.pop(name))
+        for name in selected:
+            if name not in self.curves:
+                self.curves[name] = self.add_curve(pen=curve_pens.get(name, 'w'), name=name)
+            self.curves[name].setData(trace['t'], trace[name])
+        voltage = selected[0].startswith('V')
+        if self.axes != (voltage, live):
+            self.axes = (voltage, live)
+            title = 'Modified de Gruijl inferior olive model' + (' (live)' if live else '')
+            self.graphWidget.setLabels(title=title, bottom='Time (ms)',
+                                       left='Membrane potential (mV)' if voltage else 'Current')
+            if voltage:
+                self.graphWidget.setYRange(-100, 100)
+            else:
+                self.graphWidget.enableAutoRange()
+
+    def overlay(self, trace, selected):
+        'Keep the selected variables of a finished run visible behind the next runs'
+        items = []
+        for name in selected:
+            item = self.add_curve(pen=overlay_pen)
+            item.setData(trace['t'], trace[name])
+            item.setZValue(-1)
+            items.append(item)
+        self.overlays.append((trace['t'][0], items))
+        if len(self.overlays) > overlay_runs:
+            for item in self.overlays.pop(0)[1]:
+                self.graphWidget.removeItem(item)
+
+    def on_overlay_toggled(self, overlay):
+        if not overlay:
+            for _t0, items in self.overlays:
+                for item in items:
+                    self.graphWidget.removeItem(item)
+            self.overlays = []
+
+    def plot(self, params, iv_trace, final=True):
+        start = time.perf_counter()
+        trace = dict(zip(self.record, iv_trace.T))
+        V_soma, t = trace['V_soma'], trace['t']
+        self.show_trace(trace, self.selected)
+        if self.selected[0].startswith('V'):
+            self.graphWidget.setXRange(t[0], t[0] + 1000 * sim_seconds)
+        # Runs start later after a full transient than after a warm start
+        for t0, items in self.overlays:
+            for item in items:
+                item.setPos(t[0] - t0, 0)
+        if not final:
             return
-        finally:
-            np.seterr(all='warn')
-        (soma_Ik, soma_Ikdr, soma_Ina, soma_Ical, V_soma,
-         axon_Ina, axon_Ik, V_axon,
-         dend_Icah, dend_Ikca, dend_Ih, V_dend, t) = iv_trace.T
+        self.plotted = (trace, self.selected)
+        if self.profile is not None:
+            # Draw now instead of on the next event loop iteration, so the drawing is timed
+            self.graphWidget.repaint()
+            self.profile['render_seconds'] = time.perf_counter() - start
+            start = time.perf_counter()
         # get statistics
-        idx = scipy.signal.find_peaks(V_soma, distance=5)[0]
-        peak_height = V_soma.max()
-        idx = idx[abs(V_soma[idx] - peak_height) < 5]
-        if len(idx) > 2:
-            period = np.diff(t[idx]).mean() / 1000
-            freq = 1 / period if period > 0 else 0
-        else:
-            freq = 0
-        amp = V_soma.ptp()
-        # plotting
-        self.graphWidget.clear()
-        pg.setConfigOption('foreground', 'w')
-        selected = str(self.draw_dropdown.currentText())
-        if selected.startswith('V'):
-            if   selected == 'V(soma)': V = V_soma
-            elif selected == 'V(axon)': V = V_axon
-            elif selected == 'V(dend)': V = V_dend
-            self.graphWidget.plot(t, V, color='k')
-            self.graphWidget.setRange(xRange=[t[0], t[-1]], yRange=[-100, 100])
-            self.graphWidget.setLabels(title='Modified de Gruijl inferior olive model', bottom='Time (ms)', left='Membrane potential (mV)')
-        elif selected.startswith('I'):
-            if   selected == 'I(k,soma)':   I = soma_Ik
-            elif selected == 'I(kdr,soma)': I = soma_Ikdr
-            elif selected == 'I(na,soma)':  I = soma_Ina
-            elif selected == 'I(cal,soma)': I = soma_Ical
-            elif selected == 'I(na,axon)':  I = axon_Ina
-            elif selected == 'I(k,axon)':   I = axon_Ik
-            elif selected == 'I(cah,dend)': I = dend_Icah
-            elif selected == 'I(kca,dend)': I = dend_Ikca
-            elif selected == 'I(h,dend)':   I = dend_Ih
-            self.graphWidget.plot(t, I, color='k')
-            self.graphWidget.setLabels(title='Modified de Gruijl inferior olive model', bottom='Time (ms)', left='Current')
+        stats = iofeatures.features(V_soma, t)
+        if self.profile is not None:
+            self.profile['analysis_seconds'] = time.perf_counter() - start
+        freq, amp = stats['frequency'], stats['amplitude']
         if np.isclose(params['I_pulse10ms'], 0):
             self.toplabel.setText(f'{freq:.1f} Hz, {amp:.1f} mVpp')
         else:
@@ -0,0 +1,208 @@
+import os
+import json
+import argparse
+import itertools
+import multiprocessing
+import concurrent.futures
+
+import numba
+import numpy as np
+
+import iocell
+import iocache
+import iofeatures
+
+def grid(**axes):
+    'Parameter sets on the cartesian product of the given values per parameter'
+    keys = list(axes)
+    values = np.array(list(itertools.product(*(np.atleast_1d(axes[k]) for k in keys))), dtype=np.float64)
+    return {k: values[:, i].copy() for i, k in enumerate(keys)}
+
+def latin_hypercube(n, seed=None, **ranges):
+    '''n parameter sets sampled by Latin hypercube from (low, high) per parameter
+
+    Every parameter range is split in n equal strata and each stratum is
+    sampled exactly once, in random order per parameter.'''
+    rng = np.random.default_rng(seed)
+    spec = {}
+    for k, (low, high) in ranges.items():
+        u = (rng.permutation(n) + rng.uniform(size=n)) / n
+        spec[k] = low + u * (high - low)
+    return spec
+
+def uniform(n, seed=None, **ranges):
+    'n parameter sets sampled independently and uniformly from (low, high) per parameter'
+    rng = np.random.default_rng(seed)
+    return {k: rng.uniform(low, high, n) for k, (low, high) in ranges.items()}
+
+def _chunk_filename(path, i_chunk):
+    return os.path.join(path, f'chunk_{i_chunk:06d}.npz')
+
+def _init_worker(threads):
+    numba.set_num_threads(threads)
+    iocell.precompile((np.float64,))
+
+def _simulate_chunk(params, settings, stream):
+    'Simulate one chunk of parameter sets as a batch, returns its columns'
+    traces = settings['traces']
+    fixed = {k: v for k, v in settings.items() if k in iocell.params_default}
+    kwargs = dict(record=traces, return_features=True, method=settings['method'],
+                  lut_resolution=settings['lut_resolution'], seed=settings['seed'])
+    timing = [settings[k] for k in ('skip_initial_transient_seconds', 'sim_seconds', 'delta', 'record_every')]
+    try:
+        iv_trace, features = iocell.simulate_batch(*timing, **kwargs, stream=stream, **fixed, **params)
+    except (ArithmeticError, SystemError):
+        # Some parameter set diverged (errors in parallel kernels surface as
+        # SystemError), redo the chunk per set and mark the failures nan
+        nsets = len(next(iter(params.values())))
+        iv_trace = np.full((nsets, iocell.nsteps(*timing)[1], len(traces)), np.nan)
+        features = {k: np.full(nsets, np.nan) for k in iofeatures.feature_names}
+        for i in range(nsets):
+            try:
+                iv_trace[i], cell_features = iocell.simulate(*timing, **kwargs, stream=stream + i, **fixed,
+                                                             **{k: v[i] for k, v in params.items()})
+            except ArithmeticError:
+                continue
+            for k, v in cell_features.items():
+                features[k][i] = v
+    columns = dict(params)
+    columns.update(features)
+    if traces:
+        columns['trace'] = iv_trace[:, ::settings['trace_every']].astype(np.float32)
+    return columns
+
+def _run_chunk(path, i_chunk, params, settings, cache=None, cache_bytes=2**30):
+    'Simulate one chunk of parameter sets, or take it from the iocache in directory cache, and store its columns'
+    # Noise stream of a set is its index in the sweep, independent of the chunking
+    stream = i_chunk * settings['chunk_size']
+    columns = None
+    if cache is not None:
+        cache = iocache.ResultCache(cache, memory_bytes=0, disk_bytes=cache_bytes)
+        fixed = {k: v for k, v in settings.items() if k in iocell.params_default}
+        key = iocache.key({**fixed, **params}, stream=stream, **{k: v for k, v in settings.items()
+                          if k not in iocell.params_default and k not in ('nsets', 'chunk_size')})
+        columns = cache.get(key)
+    if columns is None:
+        columns = _simulate_chunk(params, settings, stream)
+        if cache is not None:
+            cache.put(key, columns)
+    # Written under a temporary name so only complete chunks are ever found on resume
+    filename = _chunk_filename(path, i_chunk)
+    np.savez(filename + '.tmp.npz', **columns)
+    os.replace(filename + '.tmp.npz', filename)
+    return i_chunk
+
+def run(path, spec, chunk_size=1000, workers=None, threads_per_worker=1,
+        traces=(), trace_every=10, skip_initial_transient_seconds=1, sim_seconds=1, delta=0.025, record_every=20,
+        method='euler', lut_resolution=None, seed=0, progress=None, cache=None, cache_bytes=2**30, **params):
+    '''Simulate every parameter set of spec on a process pool and store the results in path
+
+    spec maps params_default keys to equally long arrays (see grid(),
+    latin_hypercube() and uniform()), params are fixed for all sets. Every
+    chunk_size sets are simulated as one iocell.simulate_batch and written to
+    their own chunk file holding one column per parameter and per feature
+    (iofeatures.feature_names, computed online), plus the variables in traces
+    as a float32 trace with every trace_every-th epoch. Sets that fail to
+    simulate get nan features. The I_noise_amp noise of set i is noise stream
+    i of seed, so results do not depend on chunk_size or workers. Running
+    again with the same arguments resumes an interrupted sweep by skipping the
+    finished chunks. progress is called with the number of finished and total
+    chunks. With cache, a directory, chunks are also kept in an
+    iocache.ResultCache of at most cache_bytes, shared between sweeps, so
+    chunks of identical parameter sets, settings (traces and trace_every
+    included) and chunk_size are not simulated again.
+    Returns load(path).'''
+    spec = {k: np.asarray(v, dtype=np.float64) for k, v in spec.items()}
+    for k in [*spec, *params]:
+        if k not in iocell.params_default:
+            raise TypeError(f'Unknown parameter: {k}')
+    for k in traces:
+        if k not in iocell.trace_names:
+            raise ValueError(f'Unknown variable: {k}')
+    nsets = len(next(iter(spec.values())))
+    if any(len(v) != nsets for v in spec.values()):
+        raise ValueError('All parameters of the spec should have the same number of sets')
+    settings = dict(
+            nsets=nsets, chunk_size=chunk_size, traces=list(traces), trace_every=trace_every,
+            skip_initial_transient_seconds=skip_initial_transient_seconds, sim_seconds=sim_seconds,
+            delta=delta, record_every=record_every, method=method, lut_resolution=lut_resolution, seed=seed,
+            **{k: float(v) for k, v in params.items()})
+    os.makedirs(path, exist_ok=True)
+    settings_filename = os.path.join(path, 'sweep.json')
+    spec_filename = os.path.join(path, 'spec.npz')
+    if os.path.exists(settings_filename):
+        with open(settings_filename) as f:
+            stored = json.load(f)
+        stored_spec = np.load(spec_filename)
+        if stored != settings or set(stored_spec.files) != set(spec) or \
+                any(not np.array_equal(stored_spec[k], v) for k, v in spec.items()):
+            raise ValueError(f'{path} holds a different sweep')
+    else:
+        np.savez(spec_filename, **spec)
+        with open(settings_filename, 'w') as f:
+            json.dump(settings, f, indent=1)
+    nchunks = -(-nsets // chunk_size)
+    todo = [i for i in range(nchunks) if not os.path.exists(_chunk_filename(path, i))]
+    if workers is None:
+        workers = max(1, (os.cpu_count() or 1) // threads_per_worker)
+    with concurrent.futures.ProcessPoolExecutor(workers, multiprocessing.get_context('spawn'),
+            initializer=_init_worker, initargs=(threads_per_worker,)) as pool:
+        futures = [pool.submit(_run_chunk, path, i,
+                               {k: v[i*chunk_size:(i+1)*chunk_size] for k, v in spec.items()}, settings,
+                               cache, cache_bytes)
+                   for i in todo]
+        for done, future in enumerate(concurrent.futures.as_completed(futures)):
+            future.result()
+            if progress is not None:
+                progress(nchunks - len(todo) + done + 1, nchunks)
+    return load(path)
+
+def load(path, columns=None):
+    '''Concatenate the columns of all finished chunks of a sweep
+
+    columns selects parameter, feature or 'trace' columns, by default all
+    except the trace. Only the selected columns are read from disk.'''
+    with open(os.path.join(path, 'sweep.json')) as f:
+        settings = json.load(f)
+    nchunks = -(-settings['nsets'] // settings['chunk_size'])
+    chunks = [np.load(_chunk_filename(path, i)) for i in range(nchunks)
+              if os.path.exists(_chunk_filename(path, i))]
+    if not chunks:
+        return {}
+    if columns is None:
+        columns = [k for k in chunks[0].files if k != 'trace']
+    return {k: np.concatenate([chunk[k] for chunk in chunks]) for k in columns}
+
+def _parse_range(s):
+    k, _, values = s.partition('=')
+    return k, [float(x) for x in values.split(':')]
+
+def main():
+    parser = argparse.ArgumentParser(description='Parameter sweep with a resumable on-disk result store')
+    parser.add_argument('path')
+    parser.add_argument('--grid', nargs='*', default=[], metavar='KEY=START:STOP:NUM')
+    parser.add_argument('--sample', nargs='*', default=[], metavar='KEY=LOW:HIGH')
+    parser.add_argument('--sampler', choices=['lhs', 'uniform'], default='lhs')
+    parser.add_argument('-n', type=int, default=1000, help='number of sampled sets')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the sampler and the noise')
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--sim-seconds', type=float, default=1)
+    parser.add_argument('--traces', nargs='*', default=[])
+    parser.add_argument('--cache', help='result cache directory shared between sweeps')
+    args = parser.parse_args()
+    if bool(args.grid) == bool(args.sample):
+        parser.error('give either --grid or --sample')
+    if args.grid:
+        spec = grid(**{k: np.linspace(start, stop, int(num)) for k, (start, stop, num) in map(_parse_range, args.grid)})
+    else:
+        sampler = latin_hypercube if args.sampler == 'lhs' else uniform
+        spec = sampler(args.n, seed=args.seed, **dict(map(_parse_range, args.sample)))
+    results = run(args.path, spec, chunk_size=args.chunk_size, workers=args.workers,
+                  sim_seconds=args.sim_seconds, traces=args.traces, seed=args.seed, cache=args.cache,
+                  progress=lambda done, total: print(f'{done}/{total} chunks', flush=True))
+    for k in iofeatures.feature_names:
+        print(f'{k:>12} min {np.nanmin(results[k]):10.3f} max {np.nanmax(results[k]):10.3f}')
+
+if __name__ == '__main__':
+    main()